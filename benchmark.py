@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""Generates synthetic databases with the codes and commands tables of the IFT Forks database and times the
+feature extraction on them, so that the speed of the engines can be measured without the study data.
+
+Every engine's ARFF output is compared to the output of the reference engine ('sql' in one process)."""
+
+import os
+import sys
+import time
+import random
+import shutil
+import hashlib
+import sqlite3
+import tempfile
+import resource
+import multiprocessing
+
+import ift_forks_featuregather as fg
+
+
+class Benchmark:
+    """Constants for the benchmark"""
+
+    """The databases to generate. 'participants' is the number of participants, 'events' the number of commands
+    of each participant, 'vocabulary' the number of made-up commands added to the ones the features use, and
+    'trigger_density' the chance that a 30 second segment of a participant's video has a codes row."""
+    SCALES = [
+        {'participants': 4, 'events': 500, 'vocabulary': 20, 'trigger_density': 0.2},
+        {'participants': 8, 'events': 1000, 'vocabulary': 50, 'trigger_density': 0.2},
+        {'participants': 11, 'events': 2000, 'vocabulary': 100, 'trigger_density': 0.2},
+    ]
+
+    """Length of every participant's video in seconds"""
+    DURATION = 3600
+
+    """The engines to time, as (ENGINE, WORKERS) pairs. The first one is the reference. The 'sql' engine takes
+    minutes on the largest scale unless PREPARE is set."""
+    ENGINES = [('sql', 1), ('plan', 1), ('set', 1), ('stream', 1), ('index', 1), ('index', 4)]
+
+    """Whether to prepare the databases with epoch columns and indexes (see prepare_database)"""
+    PREPARE = False
+
+    TRIGGER_EVENT = 'ForagingEnd'
+
+    SEED = 0
+
+
+"""Commands and EclipseCommands that the features count"""
+COMMANDS = ['FileOpenCommand', 'SelectTextCommand', 'Insert', 'Delete', 'Replace', 'UndoCommand', 'RunCommand']
+ECLIPSECOMMANDS = sorted(set(fg.Groups.search + fg.Groups.debugging_eclipsecommands + [
+    'org.eclipse.jdt.ui.edit.text.java.search.references.in.workspace',
+    'org.eclipse.jdt.ui.edit.text.java.search.references.in.project']))
+
+
+def videotime(seconds):
+    return "%02d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+def make_synthetic_db(path, participants=4, events=500, vocabulary=20, trigger_density=0.5, duration=3600,
+        seed=0):
+    """Writes a database with codes and commands tables like the IFT Forks database, filled with random events.
+    Returns the open connection."""
+    rand = random.Random(seed)
+    commands = COMMANDS + ['GeneratedCommand%d' % i for i in range(vocabulary)]
+
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE codes (participant INTEGER, videotime TEXT, retrospective TEXT, forks INTEGER, \
+        foraging_start TEXT, foraging_end TEXT)")
+    conn.execute("CREATE TABLE commands (participant INTEGER, videotime TEXT, command TEXT, eclipsecommand TEXT)")
+
+    for participant in range(2, participants + 2):
+        rows = []
+        for i in range(events):
+            if rand.random() < 0.3:
+                rows.append((participant, rand.randint(0, duration), 'EclipseCommand', rand.choice(ECLIPSECOMMANDS)))
+            else:
+                rows.append((participant, rand.randint(0, duration), rand.choice(commands), None))
+        rows.sort(key=lambda row: row[1])
+        conn.executemany("INSERT INTO commands VALUES (?, ?, ?, ?)",
+            [(participant, videotime(seconds), command, eclipsecommand)
+                for participant, seconds, command, eclipsecommand in rows])
+
+        for segment in range(0, duration, 30):
+            if rand.random() < trigger_density:
+                conn.execute("INSERT INTO codes VALUES (?, ?, ?, ?, ?, ?)",
+                    (participant, videotime(segment), rand.choice(['y', 'n', '']), rand.randint(0, 2),
+                    rand.choice(['True', 'False']), rand.choice(['True', 'False'])))
+
+    conn.commit()
+    return conn
+
+
+def peak_memory():
+    """The peak resident memory in megabytes of the largest of this process and its finished child processes, so
+    that a run with a pool of workers is measured by its largest worker when that is bigger than this process."""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+def time_extraction(db, event, engine, workers, outfile):
+    """Extracts the features of a database with an engine and writes the ARFF file. Returns the number of rows,
+    the seconds spent in gather_features (including loading an index), the seconds for the whole ARFF build and
+    a hash of the ARFF file."""
+    fg.Constants.ENGINE = engine
+    started = time.time()
+
+    conn = fg.connect(db)
+    if engine == 'index' and workers <= 1:
+        fg.use_event_index(fg.EventIndex.from_db(conn.cursor()))
+    rows = list(fg.trigger_rows(conn.cursor(), event))
+    features = fg.extract_features(conn, rows, db, workers)
+    extracted = time.time()
+
+    fg.write_arff(outfile, fg.arff_chunks(event, rows, features))
+    finished = time.time()
+    fg.use_event_index(None)
+    conn.close()
+
+    with open(outfile, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return len(rows), extracted - started, finished - started, digest
+
+def _measure(queue, db, event, engine, workers, outfile):
+    queue.put(time_extraction(db, event, engine, workers, outfile) + (peak_memory(),))
+
+def measure(db, event, engine, workers, outfile):
+    """time_extraction in a process of its own, so that its peak memory can be measured. Returns the results
+    of time_extraction and the peak memory of the largest process (see peak_memory); the workers are separate
+    processes, so a run with several of them uses up to that much in each."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(queue, db, event, engine, workers, outfile))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def run_benchmark(scales, engines, event='ForagingEnd', duration=3600, prepare=False, seed=0):
+    """Generates a database for every scale and measures every (engine, workers) pair on it. Returns a list of
+    results, one dictionary for each measurement."""
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for number, scale in enumerate(scales):
+            db = os.path.join(directory, 'synthetic%d.sqlite' % number)
+            conn = make_synthetic_db(db, duration=duration, seed=seed, **scale)
+            if prepare:
+                fg.prepare_database(conn)
+            conn.close()
+
+            reference = None
+            for engine, workers in engines:
+                outfile = os.path.join(directory, 'synthetic%d-%s-%d.arff' % (number, engine, workers))
+                rows, features_seconds, total_seconds, digest, memory = measure(db, event, engine, workers, outfile)
+                if reference is None:
+                    reference = digest
+
+                result = dict(scale)
+                result.update({'engine': engine, 'workers': workers, 'rows': rows,
+                    'features_seconds': features_seconds, 'total_seconds': total_seconds,
+                    'rows_per_second': rows / total_seconds if total_seconds > 0 else float('inf'),
+                    'peak_mb': memory, 'identical': digest == reference})
+                results.append(result)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def report(results, out=sys.stdout):
+    """Writes the results as a table."""
+    out.write("%12s %7s %11s %7s %7s %6s %10s %10s %10s %9s %10s\n" % ('participants', 'events', 'vocabulary',
+        'density', 'engine', 'workers', 'rows', 'features s', 'total s', 'rows/s', 'process MB'))
+    for result in results:
+        out.write("%12d %7d %11d %7.2f %7s %6d %10d %10.3f %10.3f %9.1f %10.1f%s\n" % (result['participants'],
+            result['events'], result['vocabulary'], result['trigger_density'], result['engine'],
+            result['workers'], result['rows'], result['features_seconds'], result['total_seconds'],
+            result['rows_per_second'], result['peak_mb'], "" if result['identical'] else "  DIFFERENT OUTPUT"))
+
+
+if __name__ == "__main__":
+    results = run_benchmark(Benchmark.SCALES, Benchmark.ENGINES, Benchmark.TRIGGER_EVENT, Benchmark.DURATION,
+        Benchmark.PREPARE, Benchmark.SEED)
+    report(results)
+
+    if not all(result['identical'] for result in results):
+        sys.exit(1)
@@ -0,0 +1,18 @@
+import unittest
+
+import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_engines_identical(self):
+        scales = [{'participants': 2, 'events': 200, 'vocabulary': 5, 'trigger_density': 0.2}]
+        engines = [('sql', 1), ('plan', 1), ('set', 1), ('index', 1), ('index', 2)]
+        results = benchmark.run_benchmark(scales, engines, duration=900)
+
+        self.assertEqual(len(engines), len(results))
+        self.assertTrue(all(result['identical'] for result in results))
+        self.assertTrue(all(result['rows'] == results[0]['rows'] > 0 for result in results))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1236 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib2
+
+import benchmark
+import ift_forks_featuregather as fg
+
+
+COMMANDS = benchmark.COMMANDS + ['EclipseCommand']
+
+
+def make_db(seed=0, participants=3, events=300, path=':memory:'):
+    """A database (in memory by default) with the codes and commands tables, filled with random events."""
+    return benchmark.make_synthetic_db(path, participants, events, vocabulary=0, trigger_density=0.2,
+        duration=1800, seed=seed)
+
+
+class FeatureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.conn = make_db()
+        self.rows = list(self.conn.execute("SELECT * FROM codes"))
+
+    def tearDown(self):
+        fg.use_event_index(None)
+        self.conn.close()
+
+    def gather_all(self):
+        return [fg.gather_features(self.conn.cursor(), row) for row in self.rows]
+
+
+class TestEventIndex(FeatureTestCase):
+    def test_counts_match_sql(self):
+        index = fg.EventIndex.from_db(self.conn.cursor())
+        for row in self.rows:
+            for start, after in [(-60, 0), (0, 60), (-60, 30), (30, 30), (10, -10)]:
+                for event in COMMANDS:
+                    fg.use_event_index(None)
+                    expected = fg.num_commands_at_fork(self.conn.cursor(), row, event, start, after)
+                    fg.use_event_index(index)
+                    self.assertEqual(expected, fg.num_commands_at_fork(self.conn.cursor(), row, event, start, after))
+
+    def test_gather_features_matches_sql(self):
+        expected = self.gather_all()
+        fg.use_event_index(fg.EventIndex.from_db(self.conn.cursor()))
+        self.assertEqual(expected, self.gather_all())
+
+    def test_row_not_in_codes(self):
+        index = fg.EventIndex.from_db(self.conn.cursor())
+        row = {'participant': 99, 'videotime': '00:10:00'}
+        self.assertEqual(0, index.count('command', 'Insert', row, -600, 600))
+
+
+class TestEventStore(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'events.store')
+        self.engine = fg.Constants.ENGINE
+        self.store = fg.Constants.STORE
+
+    def tearDown(self):
+        fg.Constants.ENGINE = self.engine
+        fg.Constants.STORE = self.store
+        shutil.rmtree(self.directory)
+        FeatureTestCase.tearDown(self)
+
+    def assertSameIndex(self, expected, index):
+        for name in ['events', 'commands', 'eclipsecommands']:
+            self.assertEqual(getattr(expected, name), dict((key, list(times))
+                for key, times in getattr(index, name).iteritems()))
+        self.assertEqual(expected.triggers, index.triggers)
+
+    def test_snapshot_round_trip(self):
+        store = fg.EventStore.from_db(self.conn.cursor(), source='test')
+        store.save(self.path)
+        loaded = fg.EventStore.load(self.path)
+        self.assertEqual('test', loaded.source)
+        self.assertEqual(len(store), len(loaded))
+        for name in fg.EventStore.COLUMNS:
+            self.assertEqual(list(store.columns[name]), list(loaded.columns[name]))
+
+        expected = fg.EventIndex.from_db(self.conn.cursor())
+        self.assertSameIndex(expected, fg.EventIndex.from_store(store))
+        self.assertSameIndex(expected, fg.EventIndex.from_store(loaded))
+        self.assertSameIndex(fg.EventIndex.from_db(self.conn.cursor(), [3]), fg.EventIndex.from_store(loaded, [3]))
+
+    def test_columns_mapped_in_place(self):
+        store = fg.EventStore.from_db(self.conn.cursor(), source='test')
+        store.save(self.path)
+        loaded = fg.EventStore.load(self.path)
+        index = fg.EventIndex.from_store(loaded)
+        for times in index.events.values():
+            self.assertNotIsInstance(times, list)
+
+        if fg.numpy is None:
+            epochs = loaded.columns['epochs']
+            self.assertIsInstance(epochs, fg.MappedColumn)
+            self.assertEqual(list(store.columns['epochs'][5:20]), list(epochs[5:20]))
+            self.assertEqual(store.columns['epochs'][-1], epochs[-1])
+            self.assertEqual(fg.bisect_left(store.columns['epochs'], 900), fg.bisect_left(epochs, 900))
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write("not a snapshot")
+        self.assertRaises(ValueError, fg.EventStore.load, self.path)
+
+    def test_snapshot_made_again_when_database_changes(self):
+        db = os.path.join(self.directory, 'study.sqlite')
+        make_db(path=db).close()
+        conn = fg.connect(db)
+        first = fg.snapshot_store(conn.cursor(), self.path, db)
+        self.assertEqual(len(first), len(fg.snapshot_store(conn.cursor(), self.path, db)))
+
+        conn.execute("INSERT INTO commands (participant, videotime, command) VALUES (2, '00:01:00', 'Insert')")
+        conn.commit()
+        self.assertEqual(len(first) + 1, len(fg.snapshot_store(conn.cursor(), self.path, db)))
+        self.assertEqual(len(first) + 1, len(fg.EventStore.load(self.path)))
+        conn.close()
+
+    def test_workers_map_snapshot(self):
+        db = os.path.join(self.directory, 'study.sqlite')
+        make_db(path=db).close()
+        conn = fg.connect(db)
+        rows = list(fg.trigger_rows(conn.cursor(), 'Fork'))
+        expected = fg.extract_features(conn, rows)
+
+        fg.Constants.ENGINE = 'index'
+        fg.Constants.STORE = self.path
+        fg.snapshot_store(conn.cursor(), self.path, db)
+        self.assertEqual(expected, fg.extract_features(conn, rows, db, workers=2))
+        conn.close()
+
+
+class TestEncoding(unittest.TestCase):
+    def setUp(self):
+        self.maps = fg.Constants.CATEGORY_MAPS
+
+    def tearDown(self):
+        fg.Constants.CATEGORY_MAPS = self.maps
+
+    def test_bins(self):
+        labels = ['None', 'None', 'Few', 'Some', 'Some', 'Some', 'Some', 'Many', 'Many', 'Many', 'Many', 'Lots',
+            'Lots', 'Lots', 'Lots', 'Lots']
+        self.assertEqual(labels, [fg.num_to_categories(n) for n in range(-1, 15)])
+
+    def test_matrix_matches_values(self):
+        matrix = [[(row * 7 + column * 3) % 17 for column in range(len(fg.relations()))] for row in range(40)]
+        encoded = fg.encode_matrix(matrix)
+        for counts, features in zip(matrix, encoded):
+            self.assertEqual(counts + [fg.num_to_categories(n) for n in counts] + [n > 0 for n in counts], features)
+            self.assertEqual(features, fg.encode_features(counts))
+
+    def test_negative_count(self):
+        counts = [0] * len(fg.relations())
+        counts[3] = -1
+        self.assertRaises(Exception, fg.encode_matrix, [counts])
+
+    def test_category_map_of_one_feature(self):
+        fg.Constants.CATEGORY_MAPS = {'runs_after': {0: 'Never', 2: 'Once', 3: 'Often'}}
+        counts = [3] * len(fg.relations())
+        categories = fg.make_features_into_categories(counts)
+        position = fg.relations().keys().index('runs_after')
+        self.assertEqual('Often', categories[position])
+        self.assertEqual(['Some'] * (len(counts) - 1), categories[:position] + categories[position + 1:])
+        self.assertTrue("category__runs_after__Fork {Never,Once,Often}" in fg.header('Fork'))
+        self.assertTrue("category__runs_before__Fork {None,Few,Some,Many,Lots}" in fg.header('Fork'))
+
+
+class TestSequencePattern(FeatureTestCase):
+    def test_declared_pattern_matches_sql(self):
+        pattern = fg.SequencePattern([('command', 'Insert'), ('command', 'Delete')], ('command', 'UndoCommand'))
+        index = fg.EventIndex.from_db(self.conn.cursor())
+        expected = [fg.num_pattern_at_fork(self.conn.cursor(), row, pattern, -120, 60) for row in self.rows]
+        self.assertTrue(sum(expected) > 0)
+        self.assertEqual(expected, index.pattern_counts(pattern, self.rows, -120, 60))
+
+    def test_search_before_open_matches_sql(self):
+        expected = [fg.num_search_before_open(self.conn.cursor(), row, -60, 30) for row in self.rows]
+        fg.use_event_index(fg.EventIndex.from_db(self.conn.cursor()))
+        self.assertEqual(expected, [fg.num_search_before_open(self.conn.cursor(), row, -60, 30) for row in self.rows])
+
+
+class TestDuplicateTriggers(FeatureTestCase):
+    """A trigger row that is in the codes table twice, which the synthetic databases never have."""
+
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.engine = fg.Constants.ENGINE
+        self.conn.execute("INSERT INTO codes VALUES (?, ?, 'n', 0, 'False', 'True')",
+            (self.rows[0]['participant'], self.rows[0]['videotime']))
+        self.rows = list(self.conn.execute("SELECT * FROM codes"))
+
+    def tearDown(self):
+        fg.Constants.ENGINE = self.engine
+        FeatureTestCase.tearDown(self)
+
+    def test_engines_match(self):
+        expected = self.gather_all()
+        self.assertEqual(expected[0], expected[-1])
+        for engine in ['plan', 'index', 'set', 'stream']:
+            fg.Constants.ENGINE = engine
+            if engine == 'index':
+                fg.use_event_index(fg.EventIndex.from_db(self.conn.cursor()))
+            self.assertEqual(expected, fg.extract_features(self.conn, self.rows))
+            fg.use_event_index(None)
+
+    def test_all_events_match_one_event(self):
+        directory = tempfile.mkdtemp()
+        try:
+            outfile = os.path.join(directory, 'out.arff')
+            fg.write_all_events(self.conn, ['Fork', 'ForagingEnd'], outfile)
+            for event in ['Fork', 'ForagingEnd']:
+                rows = list(fg.trigger_rows(self.conn.cursor(), event))
+                with open(fg.event_outfile(outfile, event)) as f:
+                    self.assertEqual("".join(fg.arff_chunks(event, rows, fg.iter_features(self.conn, rows))),
+                        f.read())
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = os.path.join(self.directory, 'ift_forks.sqlite')
+        make_db(path=self.db).close()
+        self.conn = fg.connect(self.db)
+        self.rows = list(fg.trigger_rows(self.conn.cursor(), 'Fork'))
+        self.engine = fg.Constants.ENGINE
+
+    def tearDown(self):
+        fg.Constants.ENGINE = self.engine
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def test_workers_match_single_process(self):
+        expected = fg.extract_features(self.conn, self.rows)
+        for engine in ['sql', 'index', 'set', 'stream']:
+            fg.Constants.ENGINE = engine
+            self.assertEqual(expected, fg.extract_features(self.conn, self.rows, self.db, workers=2))
+
+    def test_workers_use_cache(self):
+        expected = fg.extract_features(self.conn, self.rows)
+        cache = fg.FeatureCache(os.path.join(self.directory, 'cache.sqlite'), 'database')
+        fg.use_feature_cache(cache)
+        count_features = fg.count_features
+        try:
+            self.assertEqual(expected, fg.extract_features(self.conn, self.rows, self.db, workers=2))
+            self.assertEqual(len(set((row['participant'], row['videotime']) for row in self.rows)), len(cache))
+            # Every row is cached now, so nothing is counted again in any process.
+            fg.count_features = None
+            self.assertEqual(expected, fg.extract_features(self.conn, self.rows, self.db, workers=2))
+        finally:
+            fg.count_features = count_features
+            fg.use_feature_cache(None)
+            cache.conn.close()
+
+    def test_shards_cover_rows(self):
+        shards = fg.shard_by_participant(self.rows)
+        self.assertEqual(3, len(shards))
+        self.assertEqual(range(len(self.rows)), sorted(p for shard in shards for p in shard[1]))
+
+
+class TestArffWriter(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        FeatureTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def expected_arff(self):
+        output = fg.header('ForagingEnd', participants=fg.participant_values(self.rows))
+        for row in self.rows:
+            output += fg.features_to_datatable(fg.gather_features(self.conn.cursor(), row), row, 'ForagingEnd')
+        return output
+
+    def chunks(self):
+        return fg.arff_chunks('ForagingEnd', self.rows, fg.iter_features(self.conn, self.rows))
+
+    def test_streamed_file(self):
+        path = os.path.join(self.directory, 'out.arff')
+        fg.write_arff(path, self.chunks())
+        with open(path) as f:
+            self.assertEqual(self.expected_arff(), f.read())
+
+    def test_gzipped_file(self):
+        path = os.path.join(self.directory, 'out.arff.gz')
+        fg.write_arff(path, self.chunks(), compress=True)
+        with gzip.open(path) as f:
+            self.assertEqual(self.expected_arff(), f.read())
+
+
+class TestTwoFactor(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        fg.Constants.TWO_FACTOR = True
+
+    def tearDown(self):
+        fg.Constants.TWO_FACTOR = False
+        FeatureTestCase.tearDown(self)
+
+    def test_header_matches_rows(self):
+        chunks = list(fg.arff_chunks('ForagingEnd', self.rows, fg.iter_features(self.conn, self.rows)))
+        attributes = [line for line in chunks[0].splitlines() if line.startswith('@ATTRIBUTE')]
+        for line in chunks[1:]:
+            self.assertEqual(len(attributes), len(line.split(',')))
+
+    def test_block_matches_single_rows(self):
+        features = self.gather_all()
+        width = len(fg.relations())
+        block = fg.two_factor_block([row[:width] for row in features])
+        for row_features, interactions in zip(features, block):
+            self.assertEqual(fg.two_factor_effects(row_features), fg.two_factor_effects(row_features, interactions))
+        self.assertEqual(width * (width - 1) / 2, len(block[0]))
+
+
+class TestSparse(FeatureTestCase):
+    def setUp(self):
+        self.conn = make_db(events=30)
+        self.rows = list(self.conn.execute("SELECT * FROM codes"))
+        self.sparse = fg.Constants.SPARSE
+
+    def tearDown(self):
+        fg.Constants.SPARSE = self.sparse
+        fg.Constants.TWO_FACTOR = False
+        FeatureTestCase.tearDown(self)
+
+    def chunks(self):
+        return list(fg.arff_chunks('ForagingEnd', self.rows, fg.iter_features(self.conn, self.rows)))
+
+    def dense_values(self, line, defaults):
+        """The values of a sparse row with the defaults filled in."""
+        values = list(defaults)
+        for entry in line.strip()[1:-1].split(","):
+            if entry:
+                position, value = entry.split(" ", 1)
+                values[int(position)] = value
+        return values
+
+    def test_sparse_matches_dense(self):
+        fg.Constants.TWO_FACTOR = True
+        fg.Constants.SPARSE = False
+        dense = self.chunks()
+        fg.Constants.SPARSE = True
+        sparse = self.chunks()
+
+        self.assertIn("{False,True,None}", sparse[0])
+        self.assertEqual(dense[0].replace("{True,False,None}", "{False,True,None}"), sparse[0])
+        defaults = fg.attribute_defaults(sparse[0])
+        for dense_line, sparse_line in zip(dense[1:], sparse[1:]):
+            self.assertTrue(sparse_line.startswith("{") and sparse_line.endswith("}\n"))
+            self.assertEqual([value.strip() for value in dense_line.split(",")],
+                self.dense_values(sparse_line, defaults))
+        self.assertLess(sum(map(len, sparse)), sum(map(len, dense)))
+
+    def test_chosen_from_density(self):
+        fg.Constants.SPARSE = None
+        fg.Constants.TWO_FACTOR = True
+        chunks = self.chunks()
+        self.assertTrue(chunks[1].startswith("{"))
+        self.assertEqual(len(self.rows) + 1, len(chunks))
+
+        self.conn.close()
+        self.conn = make_db()
+        self.rows = list(self.conn.execute("SELECT * FROM codes"))
+        self.assertFalse(self.chunks()[1].startswith("{"))
+
+    def test_defaults(self):
+        self.assertEqual(["0", "None", "False", "2", "ForagingEnd"], fg.attribute_defaults(
+            "@ATTRIBUTE a__x NUMERIC\n@ATTRIBUTE category__a__x {None,Few}\n@ATTRIBUTE binary__a__x {False,True,None}\n"
+            "@ATTRIBUTE participant {2,3,4}\n@ATTRIBUTE foraging_end {ForagingEnd, NotForagingEnd}\n\n@DATA\n"))
+
+
+class TestColumns(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.ngrams = fg.Constants.NGRAMS
+
+    def tearDown(self):
+        fg.Constants.NGRAMS = self.ngrams
+        shutil.rmtree(self.directory)
+        FeatureTestCase.tearDown(self)
+
+    def matrix(self, columns, name):
+        """The rows of a file of load_columns as lists."""
+        if fg.numpy is not None:
+            return columns[name].tolist()
+        data, shape = columns[name]
+        if len(shape) == 1:
+            return list(data)
+        return [list(data[i * shape[1]:(i + 1) * shape[1]]) for i in range(shape[0])]
+
+    def test_columns_match_arff(self):
+        fg.Constants.NGRAMS = 4
+        ngrams = fg.ngram_table(self.conn.cursor(), self.rows)
+        columns = fg.FeatureColumns()
+        chunks = list(fg.arff_chunks('ForagingEnd', self.rows, columns.collect(fg.iter_features(self.conn, self.rows)),
+            ngrams))
+        columns.save(self.directory, 'ForagingEnd', self.rows, ngrams)
+        metadata, loaded = fg.load_columns(self.directory)
+
+        self.assertEqual(len(fg.header_attributes(chunks[0])), len(metadata['attributes']))
+        self.assertEqual(fg.relations().keys(), metadata['files']['counts'])
+        width = len(fg.relations())
+        for line, counts, categories, booleans, row_ngrams, participant, label in zip(chunks[1:],
+                self.matrix(loaded, 'counts'), self.matrix(loaded, 'categories'), self.matrix(loaded, 'booleans'),
+                self.matrix(loaded, 'ngrams'), self.matrix(loaded, 'participants'), self.matrix(loaded, 'labels')):
+            values = [value.strip() for value in line.split(",")]
+            self.assertEqual(values[:width], map(str, counts))
+            self.assertEqual(values[width:2 * width], [labels[code] for labels, code in
+                zip(metadata['category_labels'], categories)])
+            self.assertEqual(values[2 * width:3 * width], [str(bool(boolean)) for boolean in booleans])
+            self.assertEqual(values[3 * width:3 * width + 8], map(str, row_ngrams))
+            self.assertEqual(values[-2:], [str(metadata['participants'][participant]), metadata['labels'][label]])
+
+    def test_npy_round_trip(self):
+        path = os.path.join(self.directory, 'a.npy')
+        fg.write_npy(path, fg.array('i', [1, -2, 3, 4, 5, 1 << 30]), (2, 3))
+        self.assertEqual((fg.array('i', [1, -2, 3, 4, 5, 1 << 30]), (2, 3)), fg.read_npy(path))
+        with open(path, 'rb') as f:
+            self.assertEqual(0, len(f.read()) % 4)
+            f.seek(0)
+            self.assertEqual(0, (10 + len(f.read(128)[10:].split("\n")[0]) + 1) % 64)
+
+    def test_sweep_writes_columns(self):
+        fg.Constants.COLUMNS = os.path.join(self.directory, 'columns')
+        try:
+            configurations = fg.sweep_grid({'BEFORE': [-60, -30]})
+            outfiles = fg.sweep(self.conn, self.rows, 'ForagingEnd', configurations,
+                os.path.join(self.directory, 'out.arff'))
+            for configuration, path in zip(configurations, outfiles):
+                metadata, loaded = fg.load_columns(fg.sweep_outfile(fg.Constants.COLUMNS, configuration))
+                with open(path) as f:
+                    lines = [line for line in f.read().split("\n") if line and not line.startswith("@")]
+                self.assertEqual([line.split(",")[0].strip() for line in lines],
+                    [str(row[0]) for row in self.matrix(loaded, 'counts')])
+        finally:
+            fg.Constants.COLUMNS = None
+
+    def test_incremental_rejects_columns(self):
+        fg.Constants.COLUMNS = os.path.join(self.directory, 'columns')
+        try:
+            self.assertRaises(ValueError, fg.update_arff, self.conn, self.rows, 'ForagingEnd',
+                os.path.join(self.directory, 'out.arff'))
+        finally:
+            fg.Constants.COLUMNS = None
+
+
+class TestService(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = os.path.join(self.directory, 'study.sqlite')
+        self.conn = make_db(path=self.db)
+        self.rows = list(self.conn.execute("SELECT * FROM codes"))
+        self.server = fg.feature_server(self.db, 0)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def post(self, request):
+        response = urllib2.urlopen("http://%s:%d/features" % self.server.server_address, json.dumps(request))
+        return response.read()
+
+    def expected_arff(self, rows):
+        return "".join(fg.arff_chunks('ForagingEnd', rows, fg.iter_features(self.conn, rows)))
+
+    def test_arff_matches_run(self):
+        self.assertEqual(self.expected_arff(self.rows), self.post({'event': 'ForagingEnd', 'format': 'arff'}))
+
+    def test_overrides_and_triggers(self):
+        rows = self.rows[3:6]
+        answer = json.loads(self.post({'event': 'ForagingEnd', 'constants': {'BEFORE': -30, 'TWO_FACTOR': True},
+            'triggers': [[row['participant'], row['videotime']] for row in rows]}))
+
+        fg.Constants.BEFORE = -30
+        fg.Constants.TWO_FACTOR = True
+        try:
+            chunks = self.expected_arff(rows).split("@DATA\n")[1].splitlines()
+            attributes = fg.header_attributes(fg.header('ForagingEnd', participants=fg.participant_values(self.rows)))
+        finally:
+            fg.Constants.BEFORE = -60
+            fg.Constants.TWO_FACTOR = False
+
+        self.assertEqual(json.loads(json.dumps(attributes)), answer['attributes'])
+        self.assertEqual([row['videotime'] for row in rows], [row['videotime'] for row in answer['rows']])
+        for line, row in zip(chunks, answer['rows']):
+            self.assertEqual([value.strip() for value in line.split(",")], [str(value) for value in row['values']])
+        self.assertEqual(-60, fg.Constants.BEFORE)
+
+    def test_bad_request(self):
+        with self.assertRaises(urllib2.HTTPError) as raised:
+            self.post({'constants': {'DB': 'other.sqlite'}})
+        self.assertEqual(400, raised.exception.code)
+        self.assertIn('DB', json.loads(raised.exception.read())['error'])
+
+        for request in [[1, 2], {'triggers': 5}, {'triggers': [[2]]}, {'constants': {'BEFORE': "x"}},
+                {'constants': {'CATEGORY_MAPS': {'a': 1}}}, {'constants': []}, {'event': []}, {'format': 'xml'}]:
+            with self.assertRaises(urllib2.HTTPError) as raised:
+                self.post(request)
+            self.assertEqual(400, raised.exception.code)
+            self.assertIn('error', json.loads(raised.exception.read()))
+        self.assertEqual(-60, fg.Constants.BEFORE)
+
+    def test_missing_database(self):
+        os.remove(self.db)
+        for open_request in [lambda: urllib2.urlopen("http://%s:%d/" % self.server.server_address),
+                lambda: self.post({'format': 'arff'})]:
+            with self.assertRaises(urllib2.HTTPError) as raised:
+                open_request()
+            self.assertEqual(500, raised.exception.code)
+            self.assertIn('error', json.loads(raised.exception.read()))
+
+    def test_reloads_changed_database(self):
+        before = self.post({'format': 'arff'})
+        self.assertFalse(self.server.service.refresh())
+
+        self.conn.executemany("INSERT INTO commands VALUES (?, ?, 'RunCommand', NULL)",
+            [(row['participant'], row['videotime']) for row in self.rows])
+        self.conn.commit()
+        stamp = os.stat(self.db).st_mtime + 10
+        os.utime(self.db, (stamp, stamp))
+
+        after = self.post({'format': 'arff'})
+        self.assertNotEqual(before, after)
+        self.assertEqual(self.expected_arff(self.rows), after)
+
+
+class TestStudies(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.databases = []
+        for seed, study in enumerate(['replication', 'original']):
+            path = os.path.join(self.directory, study + '.sqlite')
+            make_db(seed, participants=2 + seed, path=path).close()
+            self.databases.append((study, path))
+
+    def tearDown(self):
+        fg.Constants.NGRAMS = 0
+        shutil.rmtree(self.directory)
+
+    def single_run(self, study, db):
+        """The data lines of one database on its own, with the participants renamed."""
+        conn = fg.connect(db)
+        rows = list(fg.trigger_rows(conn.cursor(), 'ForagingEnd'))
+        study_rows = [dict(zip(row.keys(), row), participant=fg.study_participant(study, row['participant']))
+            for row in rows]
+        lines = list(fg.arff_chunks('ForagingEnd', study_rows, fg.iter_features(conn, rows)))[1:]
+        conn.close()
+        return lines
+
+    def test_merged_matches_single_runs(self):
+        outfile = os.path.join(self.directory, 'all.arff')
+        self.assertEqual([outfile], fg.write_studies(self.databases, ['ForagingEnd'], outfile, workers=2))
+        with open(outfile) as f:
+            content = f.read()
+
+        self.assertIn("@ATTRIBUTE participant {original_2,original_3,original_4,replication_2,replication_3}",
+            content)
+        lines = content.split("@DATA\n")[1].splitlines(True)
+        self.assertEqual(self.single_run(*self.databases[0]) + self.single_run(*self.databases[1]), lines)
+
+    def test_one_file_per_study(self):
+        fg.Constants.NGRAMS = 3
+        outfile = os.path.join(self.directory, 'all.arff')
+        outfiles = fg.write_studies(self.databases, ['ForagingEnd'], outfile, merge=False)
+        self.assertEqual([os.path.join(self.directory, 'all-replication.arff'),
+            os.path.join(self.directory, 'all-original.arff')], outfiles)
+
+        headers = []
+        for path in outfiles:
+            with open(path) as f:
+                headers.append(f.read().split("@DATA\n")[0])
+        self.assertEqual(headers[0], headers[1])
+        self.assertEqual(6, headers[0].count("@ATTRIBUTE ngram__"))
+
+    def test_all_events_extracted_once(self):
+        fg.Constants.COLUMNS = os.path.join(self.directory, 'columns')
+        outfile = os.path.join(self.directory, 'all.arff')
+        try:
+            outfiles = fg.write_studies(self.databases, fg.TRIGGER_EVENTS, outfile, merge=False)
+        finally:
+            fg.Constants.COLUMNS = None
+        self.assertEqual(6, len(outfiles))
+        self.assertIn(os.path.join(self.directory, 'all-Fork-original.arff'), outfiles)
+
+        for event in fg.TRIGGER_EVENTS:
+            for study, db in self.databases:
+                directory = os.path.join(self.directory, 'columns-%s-%s' % (event, study))
+                metadata, columns = fg.load_columns(directory)
+                self.assertEqual(event, metadata['event'])
+
+        results = fg.extract_study('original', self.databases[1][1], fg.TRIGGER_EVENTS)
+        self.assertEqual(fg.TRIGGER_EVENTS, [event for event, result in results])
+        self.assertIs(results[0][1][1][0], results[1][1][1][0])
+
+    def test_participant_order(self):
+        self.assertEqual([2, 3, 10], fg.participant_values([{'participant': p} for p in [10, 3, 2, 3]]))
+        self.assertEqual(['a_2', 'a_10', 'b_1'], fg.participant_values([{'participant': p}
+            for p in ['b_1', 'a_10', 'a_2']]))
+
+
+class TestQueryPlan(FeatureTestCase):
+    def tearDown(self):
+        fg.Constants.ENGINE = 'sql'
+        FeatureTestCase.tearDown(self)
+
+    def test_matches_row_at_a_time(self):
+        expected = self.gather_all()
+        fg.Constants.ENGINE = 'plan'
+        self.assertEqual(expected, self.gather_all())
+        fg.prepare_database(self.conn)
+        self.assertEqual(expected, self.gather_all())
+
+    def test_shared_windows(self):
+        windows, patterns = fg.plan_queries(fg.feature_terms())
+        self.assertEqual(4, len(windows))
+        self.assertEqual(2, len(patterns))
+
+
+class TestFeatureSelection(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.features = fg.Constants.FEATURES
+        self.engine = fg.Constants.ENGINE
+
+    def tearDown(self):
+        fg.Constants.FEATURES = self.features
+        fg.Constants.ENGINE = self.engine
+        fg.use_profiler(None)
+        FeatureTestCase.tearDown(self)
+
+    def test_registry_matches_relations(self):
+        self.assertEqual(fg.feature_registry().keys(), fg.relations().keys())
+        self.assertEqual(fg.feature_registry().keys(), fg.feature_terms().keys())
+
+    def test_registry_built_once_per_window(self):
+        before = fg.Constants.BEFORE
+        registry = fg.feature_registry()
+        self.assertTrue(registry is fg.feature_registry())
+        try:
+            fg.Constants.BEFORE = before - 10
+            self.assertFalse(registry is fg.feature_registry())
+            self.assertEqual(before - 10, fg.feature_registry()['edits_before'].terms[0][2])
+        finally:
+            fg.Constants.BEFORE = before
+
+    def test_subset_matches_all_features(self):
+        names = fg.relations().keys()
+        all_counts = [fg.count_features(self.conn.cursor(), row) for row in self.rows]
+
+        fg.Constants.FEATURES = ['runs_after', 'exists_search_before_open', 'edits_before']
+        self.assertEqual(['edits_before', 'runs_after', 'exists_search_before_open'], fg.relations().keys())
+        expected = [[counts[names.index(name)] for name in fg.relations()] for counts in all_counts]
+        for engine in ['sql', 'plan', 'index', 'set', 'stream']:
+            fg.Constants.ENGINE = engine
+            if engine == 'index':
+                fg.use_event_index(fg.EventIndex.from_db(self.conn.cursor()))
+            features = list(fg.iter_features(self.conn, self.rows))
+            self.assertEqual(expected, [row[:3] for row in features])
+            self.assertEqual(9, len(features[0]))
+            fg.use_event_index(None)
+
+        arff_header = fg.header('Fork')
+        self.assertEqual(9, arff_header.count("@ATTRIBUTE") - 2)
+        self.assertFalse("opens_before" in arff_header)
+
+    def test_other_queries_skipped(self):
+        fg.Constants.FEATURES = ['runs_after']
+        profiler = fg.Profiler()
+        fg.use_profiler(profiler)
+        fg.gather_features(self.conn.cursor(), self.rows[0])
+        self.assertEqual(['runs_after'], profiler.features.keys())
+
+    def test_unknown_feature(self):
+        fg.Constants.FEATURES = ['runs_after', 'no_such_feature']
+        self.assertRaises(ValueError, fg.relations)
+
+
+class TestExistence(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.settings = fg.settings()
+
+    def tearDown(self):
+        fg.apply_settings(self.settings)
+        FeatureTestCase.tearDown(self)
+
+    def test_index_exists_matches_count(self):
+        index = fg.EventIndex.from_db(self.conn.cursor())
+        for row in self.rows + [{'participant': 99, 'videotime': '00:10:00'}]:
+            for start, after in [(-60, 0), (0, 60), (30, 30), (10, -10)]:
+                for event in COMMANDS:
+                    self.assertEqual(index.count('command', event, row, start, after) > 0,
+                        index.exists('command', event, row, start, after))
+
+    def test_booleans_only_match_full_run(self):
+        width = len(fg.relations())
+        expected = [features[-width:] for features in self.gather_all()]
+
+        fg.Constants.NUMERIC = False
+        fg.Constants.CATEGORY = False
+        self.assertTrue(fg.existence_only())
+        for engine in ['sql', 'plan', 'index', 'set', 'stream']:
+            fg.Constants.ENGINE = engine
+            if engine == 'index':
+                fg.use_event_index(fg.EventIndex.from_db(self.conn.cursor()))
+            features = list(fg.iter_features(self.conn, self.rows))
+            self.assertEqual(expected, [row[-width:] for row in features])
+            fg.use_event_index(None)
+
+        line = fg.features_to_datatable(features[0], self.rows[0], 'ForagingEnd')
+        self.assertEqual(width + 2, len(line.split(",")))
+        self.assertFalse("@ATTRIBUTE opens_before__" in fg.header('ForagingEnd'))
+        self.assertTrue("@ATTRIBUTE binary__opens_before__" in fg.header('ForagingEnd'))
+
+    def test_columns_match_between_engines(self):
+        fg.Constants.NUMERIC = False
+        fg.Constants.CATEGORY = False
+        directory = tempfile.mkdtemp()
+        try:
+            exported = []
+            for engine in ['sql', 'set', 'stream']:
+                fg.Constants.ENGINE = engine
+                columns = fg.FeatureColumns()
+                list(columns.collect(fg.iter_features(self.conn, self.rows)))
+                path = os.path.join(directory, engine)
+                columns.save(path, 'ForagingEnd', self.rows)
+                metadata, loaded = fg.load_columns(path)
+                self.assertEqual(['booleans'], metadata['files'].keys())
+                exported.append(list(loaded['booleans'][0]) if fg.numpy is None else loaded['booleans'].tolist())
+            self.assertEqual(exported[0], exported[1])
+            self.assertEqual(exported[0], exported[2])
+            self.assertEqual(list(columns.counts), [int(count > 0) for count in columns.counts])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_existence_counts_are_not_cached_as_counts(self):
+        configuration = fg.feature_configuration()
+        fg.Constants.NUMERIC = False
+        fg.Constants.CATEGORY = False
+        self.assertNotEqual(configuration, fg.feature_configuration())
+
+
+class TestGroups(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.settings = fg.settings()
+
+    def tearDown(self):
+        fg.apply_settings(self.settings)
+        fg.use_profiler(None)
+        shutil.rmtree(self.directory)
+        FeatureTestCase.tearDown(self)
+
+    def use_groups(self, definitions):
+        path = os.path.join(self.directory, 'groups.json')
+        with open(path, 'w') as f:
+            json.dump(definitions, f)
+        fg.Constants.GROUPS = path
+
+    def test_members_counted_once(self):
+        search = fg.group_members('search')
+        self.assertEqual(len(set(search)), len(search))
+
+        row = self.rows[0]
+        before = fg.num_searching_before(self.conn.cursor(), row)
+        self.conn.execute("INSERT INTO commands (participant, videotime, command, eclipsecommand) VALUES (?, ?, ?, ?)",
+            (row['participant'], row['videotime'], 'EclipseCommand', 'org.eclipse.search.ui.performTextSearchFile'))
+        self.assertEqual(before + 1, fg.num_searching_before(self.conn.cursor(), row))
+
+    def test_group_from_file(self):
+        debug = 'org.eclipse.debug.ui.commands.'
+        self.use_groups({'stepping': [debug + 'StepInto', debug + 'StepOver', debug + 'StepInto']})
+        self.assertEqual((debug + 'StepInto', debug + 'StepOver'), fg.group_members('stepping'))
+        self.assertEqual(['stepping_before', 'stepping_after'], fg.relations().keys()[-2:])
+
+        expected = self.gather_all()
+        self.assertTrue(sum(features[len(fg.relations()) - 2] for features in expected) > 0)
+        for engine in ['plan', 'set', 'stream']:
+            fg.Constants.ENGINE = engine
+            self.assertEqual(expected, list(fg.iter_features(self.conn, self.rows)))
+        fg.use_event_index(fg.EventIndex.from_db(self.conn.cursor()))
+        self.assertEqual(expected, self.gather_all())
+
+    def test_edited_file_read_again(self):
+        self.use_groups({'stepping': ['a']})
+        self.assertEqual(('a',), fg.group_members('stepping'))
+        self.use_groups({'stepping': ['a', 'b']})
+        stamp = os.stat(fg.Constants.GROUPS).st_mtime + 10
+        os.utime(fg.Constants.GROUPS, (stamp, stamp))
+        self.assertEqual(('a', 'b'), fg.group_members('stepping'))
+
+    def test_one_query_per_group(self):
+        self.use_groups({'search': list(fg.Groups.search) * 2})
+        fg.Constants.FEATURES = ['searching_before', 'debugging_after']
+        db = os.path.join(self.directory, 'study.sqlite')
+        make_db(path=db).close()
+        conn = fg.connect(db, profile=True)
+        row = conn.execute("SELECT * FROM codes").fetchone()
+        # The first run also looks whether the database is prepared.
+        fg.gather_features(conn.cursor(), row)
+        profiler = fg.Profiler()
+        fg.use_profiler(profiler)
+        fg.gather_features(conn.cursor(), row)
+        conn.close()
+        self.assertEqual(1, profiler.features['searching_before']['statements'])
+        self.assertEqual(1, profiler.features['debugging_after']['statements'])
+
+
+class TestNgrams(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.ngrams = fg.Constants.NGRAMS
+
+    def tearDown(self):
+        fg.Constants.NGRAMS = self.ngrams
+        shutil.rmtree(self.directory)
+        FeatureTestCase.tearDown(self)
+
+    def naive_counts(self, row, start, after, sizes):
+        """The n-grams of one window, counted from scratch."""
+        tokens = [event[1] if event[1] is not None else event[0] for event in self.conn.execute(
+            "SELECT c.command, c.eclipsecommand FROM commands AS c, codes AS t \
+            WHERE c.participant = ? AND t.participant = ? AND t.videotime = ? \
+            AND CAST(strftime('%s', c.videotime) AS INTEGER) - CAST(strftime('%s', t.videotime) AS INTEGER) \
+                BETWEEN ? AND ? \
+            ORDER BY CAST(strftime('%s', c.videotime) AS INTEGER), c.rowid",
+            (row['participant'], row['participant'], row['videotime'], start, after))]
+        counts = {}
+        for size in sizes:
+            for i in range(len(tokens) - size + 1):
+                gram = tuple(tokens[i:i + size])
+                counts[gram] = counts.get(gram, 0) + 1
+        return counts
+
+    def test_rolling_matches_recounting(self):
+        windows = [(-60, 30), (30, 90)]
+        counts = fg.ngram_counts(self.conn.cursor(), self.rows, windows, [1, 2, 3])
+        for row, row_counts in zip(self.rows, counts):
+            self.assertEqual([self.naive_counts(row, start, after, [1, 2, 3]) for start, after in windows],
+                row_counts)
+        self.assertEqual([{}, {}], fg.ngram_counts(self.conn.cursor(), [{'participant': 99, 'videotime': '00:10:00'}],
+            windows, [2])[0])
+
+    def test_commands_without_token_skipped(self):
+        fg.Constants.NGRAMS = 5
+        row = self.rows[0]
+        self.conn.execute("INSERT INTO commands (participant, videotime) VALUES (?, ?)",
+            (row['participant'], row['videotime']))
+        counts = fg.ngram_counts(self.conn.cursor(), [row], [(-60, 30)], [1, 2])[0][0]
+        self.assertFalse(any(None in gram for gram in counts))
+        self.assertEqual(10, len(fg.ngram_names(fg.ngram_table(self.conn.cursor(), self.rows).grams)))
+
+    def test_top_ngrams_in_arff(self):
+        fg.Constants.NGRAMS = 5
+        table = fg.ngram_table(self.conn.cursor(), self.rows)
+        self.assertEqual(5, len(table.grams))
+        self.assertTrue(all(len(row_counts) == 10 for row_counts in table.counts))
+        totals = [sum(row_counts[2 * i] + row_counts[2 * i + 1] for row_counts in table.counts) for i in range(5)]
+        self.assertEqual(sorted(totals, reverse=True), totals)
+
+        chunks = list(fg.arff_chunks('ForagingEnd', self.rows, fg.iter_features(self.conn, self.rows), table))
+        self.assertEqual(10, chunks[0].count("@ATTRIBUTE ngram__"))
+        plain = list(fg.arff_chunks('ForagingEnd', self.rows, fg.iter_features(self.conn, self.rows)))
+        self.assertEqual(len(plain[1].split(",")) + 10, len(chunks[1].split(",")))
+
+    def test_incremental(self):
+        fg.Constants.NGRAMS = 3
+        path = os.path.join(self.directory, 'out.arff')
+        fg.update_arff(self.conn, self.rows, 'ForagingEnd', path)
+        self.assertEqual(0, fg.update_arff(self.conn, self.rows, 'ForagingEnd', path))
+        with open(path) as f:
+            expected = "".join(fg.arff_chunks('ForagingEnd', self.rows, fg.iter_features(self.conn, self.rows),
+                fg.ngram_table(self.conn.cursor(), self.rows)))
+            self.assertEqual(expected, f.read())
+
+    def test_attribute_names(self):
+        self.assertEqual("ngram__Insert-then-Delete__before__Fork",
+            fg._arff_name("ngram__Insert-then-Delete__before__Fork"))
+        self.assertEqual("'ngram__Run Last__after'", fg._arff_name("ngram__Run Last__after"))
+
+
+class TestSweep(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        FeatureTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_prefix_index_matches_event_index(self):
+        events = fg.EventIndex.from_db(self.conn.cursor())
+        prefixes = fg.PrefixIndex.from_db(self.conn.cursor())
+        pattern = fg.sequence_patterns()['search_before_open']
+        for row in self.rows:
+            for start, after in [(-60, 0), (-90, 30), (30, 30), (10, -10)]:
+                for event in COMMANDS:
+                    self.assertEqual(events.count('command', event, row, start, after),
+                        prefixes.count('command', event, row, start, after))
+                self.assertEqual(events.pattern_count(pattern, row, start, after),
+                    prefixes.pattern_count(pattern, row, start, after))
+
+    def test_sweep_matches_single_runs(self):
+        configurations = fg.sweep_grid({'BEFORE': [-60, -30], 'AFTER': [30, 90]})
+        self.assertEqual(4, len(configurations))
+        outfiles = fg.sweep(self.conn, self.rows, 'ForagingEnd', configurations,
+            os.path.join(self.directory, 'out.arff'))
+        self.assertEqual(-60, fg.Constants.BEFORE)
+
+        for configuration, path in zip(configurations, outfiles):
+            original = fg.settings()
+            fg.apply_settings(configuration)
+            try:
+                expected = "".join(fg.arff_chunks('ForagingEnd', self.rows, fg.iter_features(self.conn, self.rows)))
+            finally:
+                fg.apply_settings(original)
+            with open(path) as f:
+                self.assertEqual(expected, f.read())
+
+    def test_compressed_outfile_keeps_extensions(self):
+        configuration = {'BEFORE': -60, 'AFTER': 30}
+        self.assertEqual('x_after30_before-60.arff', fg.sweep_outfile('x.arff', configuration))
+        self.assertEqual('x_after30_before-60.arff.gz', fg.sweep_outfile('x.arff.gz', configuration))
+
+
+class TestFeatureCache(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.cache = fg.FeatureCache(os.path.join(self.directory, 'cache.sqlite'), 'database', max_rows=20)
+        fg.use_feature_cache(self.cache)
+
+    def tearDown(self):
+        fg.use_feature_cache(None)
+        fg.Constants.CATEGORY = True
+        fg.Constants.BEFORE = -60
+        self.cache.conn.close()
+        FeatureTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def distinct_rows(self):
+        return len(set((row['participant'], row['videotime']) for row in self.rows))
+
+    def test_encodings_from_cached_counts(self):
+        expected = self.gather_all()
+        self.assertEqual(self.distinct_rows(), len(self.cache))
+        fg.Constants.CATEGORY = False
+
+        count_features = fg.count_features
+        fg.count_features = None
+        try:
+            features = self.gather_all()
+        finally:
+            fg.count_features = count_features
+
+        width = len(fg.relations())
+        self.assertEqual([row[:width] + row[2 * width:] for row in expected], features)
+
+    def test_set_mode_uses_cache(self):
+        expected = fg.gather_features_set(self.conn.cursor(), self.rows)
+        self.assertEqual(expected, fg.gather_features_set(self.conn.cursor(), self.rows))
+        self.assertEqual(expected, self.gather_all())
+
+    def test_window_change_misses(self):
+        self.gather_all()
+        fg.Constants.BEFORE = -30
+        self.assertEqual(None, self.cache.get(self.rows[0]))
+        self.gather_all()
+        self.assertEqual(2 * self.distinct_rows(), len(self.cache))
+        self.cache.invalidate()
+        self.assertEqual(self.distinct_rows(), len(self.cache))
+
+    def test_evict(self):
+        self.gather_all()
+        self.cache.evict()
+        self.assertEqual(20, len(self.cache))
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache))
+
+
+class TestIncremental(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'out.arff')
+
+    def tearDown(self):
+        fg.Constants.CATEGORY = True
+        FeatureTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def full_build(self, rows):
+        return "".join(fg.arff_chunks('ForagingEnd', rows, fg.iter_features(self.conn, rows)))
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_only_new_rows_extracted(self):
+        self.assertEqual(len(self.rows) - 5, fg.update_arff(self.conn, self.rows[:-5], 'ForagingEnd', self.path))
+        self.assertEqual(5, fg.update_arff(self.conn, self.rows, 'ForagingEnd', self.path))
+        self.assertEqual(self.full_build(self.rows), self.read())
+        self.assertEqual(0, fg.update_arff(self.conn, self.rows, 'ForagingEnd', self.path))
+
+    def test_changed_row_extracted(self):
+        fg.update_arff(self.conn, self.rows, 'ForagingEnd', self.path)
+        rows = [dict(zip(row.keys(), row)) for row in self.rows]
+        rows[3]['foraging_end'] = 'True' if rows[3]['foraging_end'] != 'True' else 'False'
+        self.assertEqual(1, fg.update_arff(self.conn, rows, 'ForagingEnd', self.path))
+        self.assertEqual(self.full_build(rows), self.read())
+
+    def test_compressed_unchanged_run_extracts_nothing(self):
+        path = self.path + ".gz"
+        self.assertEqual(len(self.rows), fg.update_arff(self.conn, self.rows, 'ForagingEnd', path))
+        self.assertEqual(0, fg.update_arff(self.conn, self.rows, 'ForagingEnd', path))
+        with gzip.open(path, 'rb') as f:
+            self.assertEqual(self.full_build(self.rows), f.read())
+
+    def test_changed_header_rebuilds(self):
+        fg.update_arff(self.conn, self.rows, 'ForagingEnd', self.path)
+        fg.Constants.CATEGORY = False
+        self.assertEqual(len(self.rows), fg.update_arff(self.conn, self.rows, 'ForagingEnd', self.path))
+        self.assertEqual(self.full_build(self.rows), self.read())
+
+    def test_changed_commands_rebuilds(self):
+        fg.update_arff(self.conn, self.rows, 'ForagingEnd', self.path)
+        self.conn.execute("INSERT INTO commands VALUES (2, '00:01:00', 'Insert', NULL)")
+        self.assertEqual(len(self.rows), fg.update_arff(self.conn, self.rows, 'ForagingEnd', self.path))
+
+
+class TestAllEvents(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        FeatureTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_matches_single_event_runs(self):
+        outfiles = fg.write_all_events(self.conn, fg.TRIGGER_EVENTS, os.path.join(self.directory, 'out.arff.gz'),
+            compress=True)
+        self.assertEqual(['out-Fork.arff.gz', 'out-Foraging.arff.gz', 'out-ForagingEnd.arff.gz'],
+            [os.path.basename(path) for path in outfiles])
+
+        for event, path in zip(fg.TRIGGER_EVENTS, outfiles):
+            rows = list(fg.trigger_rows(self.conn.cursor(), event))
+            expected = "".join(fg.arff_chunks(event, rows, fg.iter_features(self.conn, rows)))
+            with gzip.open(path) as f:
+                self.assertEqual(expected, f.read())
+
+    def test_ignored_settings_rejected(self):
+        settings = fg.settings()
+        try:
+            fg.check_settings()
+            for values in [{'SWEEP': {'BEFORE': [-30]}, 'INCREMENTAL': 'out.arff'},
+                    {'TRIGGER_EVENT': 'All', 'SWEEP': {'BEFORE': [-30]}},
+                    {'TRIGGER_EVENT': 'All', 'INCREMENTAL': 'out.arff'},
+                    {'TRIGGER_EVENT': 'All', 'PROGRESS': True},
+                    {'DATABASES': {'a': 'a.sqlite'}, 'PROGRESS': True}]:
+                fg.apply_settings(settings)
+                fg.apply_settings(values)
+                self.assertRaises(ValueError, fg.check_settings)
+        finally:
+            fg.apply_settings(settings)
+
+
+class TestSetMode(FeatureTestCase):
+    def test_matches_row_at_a_time(self):
+        self.assertEqual(self.gather_all(), fg.gather_features_set(self.conn.cursor(), self.rows))
+
+    def test_terms_match_features(self):
+        self.assertEqual(len(fg.count_features(self.conn.cursor(), self.rows[0])), len(fg.feature_terms()))
+
+
+class TestStreamMode(FeatureTestCase):
+    def setUp(self):
+        FeatureTestCase.setUp(self)
+        self.stream_rows = fg.Constants.STREAM_ROWS
+
+    def tearDown(self):
+        fg.Constants.STREAM_ROWS = self.stream_rows
+        FeatureTestCase.tearDown(self)
+
+    def test_matches_row_at_a_time(self):
+        fg.Constants.STREAM_ROWS = 7
+        self.assertEqual(self.gather_all(), fg.gather_features_stream(self.conn.cursor(), self.rows))
+
+    def test_some_rows_of_a_prepared_database(self):
+        rows = self.rows[::3] + [{'participant': 99, 'videotime': '00:10:00'}]
+        expected = fg.set_count_features(self.conn.cursor(), rows)
+        fg.prepare_database(self.conn)
+        self.assertEqual(expected, fg.stream_count_features(self.conn.cursor(), rows))
+
+    def test_terms_match_features(self):
+        positions, windows, anchors, followers = fg._stream_lookups(fg.feature_terms())
+        self.assertEqual(len(set(term for feature in fg.feature_terms().values() for term in feature)),
+            len(positions))
+
+
+class TestPrepareDatabase(FeatureTestCase):
+    def test_prepared_queries_match(self):
+        expected = self.gather_all()
+        fg.prepare_database(self.conn)
+        self.assertTrue(fg.epoch_columns_ready(self.conn.cursor()))
+        self.assertEqual(expected, self.gather_all())
+        self.assertEqual(expected, fg.gather_features_set(self.conn.cursor(), self.rows))
+
+    def test_idempotent_and_stale(self):
+        self.assertEqual(None, fg.stale_epoch_rows(self.conn.cursor()))
+        fg.prepare_database(self.conn)
+        fg.prepare_database(self.conn)
+        self.assertEqual(0, fg.stale_epoch_rows(self.conn.cursor()))
+
+        self.conn.execute("INSERT INTO commands (participant, videotime, command) VALUES (2, '00:01:00', 'Insert')")
+        self.conn.execute("UPDATE codes SET videotime = '00:02:00' WHERE rowid = 1")
+        self.assertEqual(0, fg.stale_epoch_rows(self.conn.cursor()))
+
+        for trigger in fg.EPOCH_TRIGGERS:
+            self.conn.execute("DROP TRIGGER " + trigger)
+        self.conn.execute("INSERT INTO commands (participant, videotime, command) VALUES (2, '00:01:00', 'Insert')")
+        self.assertEqual(1, fg.stale_epoch_rows(self.conn.cursor()))
+        self.assertFalse(fg.epoch_columns_ready(self.conn.cursor()))
+        fg.prepare_database(self.conn)
+        self.assertEqual(0, fg.stale_epoch_rows(self.conn.cursor()))
+        self.assertTrue(fg.epoch_columns_ready(self.conn.cursor()))
+
+    def test_rows_not_scanned_per_query(self):
+        expected = self.gather_all()
+        fg.prepare_database(self.conn)
+        stale_epoch_rows = fg.stale_epoch_rows
+        fg.stale_epoch_rows = None
+        try:
+            self.assertEqual(expected, self.gather_all())
+        finally:
+            fg.stale_epoch_rows = stale_epoch_rows
+
+    def test_writes_of_other_connections(self):
+        directory = tempfile.mkdtemp()
+        try:
+            db = os.path.join(directory, 'study.sqlite')
+            make_db(path=db).close()
+            conn = fg.connect(db)
+            fg.prepare_database(conn)
+            self.assertTrue(fg.epoch_columns_ready(conn.cursor()))
+
+            writer = fg.connect(db)
+            writer.execute("INSERT INTO commands (participant, videotime, command) VALUES (2, '00:01:00', 'Insert')")
+            writer.commit()
+            writer.close()
+            self.assertTrue(fg.epoch_columns_ready(conn.cursor()))
+            self.assertEqual(0, fg.stale_epoch_rows(conn.cursor()))
+
+            conn.close()
+            closed = fg.weakref.ref(conn)
+            del conn
+            self.assertEqual(None, closed())
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = os.path.join(self.directory, 'study.sqlite')
+        make_db(path=self.db).close()
+        self.conn = fg.connect(self.db, profile=True)
+        self.rows = list(self.conn.execute("SELECT * FROM codes"))
+        self.profiler = fg.Profiler(steps=100)
+        self.profiler.attach(self.conn)
+        fg.use_profiler(self.profiler)
+
+    def tearDown(self):
+        fg.use_profiler(None)
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def test_features_profiled(self):
+        fg.use_profiler(None)
+        unprofiled = fg.connect(self.db)
+        expected = [fg.gather_features(unprofiled.cursor(), row) for row in self.rows]
+        unprofiled.close()
+        fg.use_profiler(self.profiler)
+        self.assertEqual(expected, [fg.gather_features(self.conn.cursor(), row) for row in self.rows])
+
+        self.assertEqual(fg.relations().keys(), [name for name in self.profiler.features
+            if name != fg.Profiler.OUTSIDE])
+        for name, stats in self.profiler.features.items():
+            if name != fg.Profiler.OUTSIDE:
+                self.assertEqual(len(self.rows), stats['calls'])
+                self.assertTrue(stats['statements'] >= len(self.rows))
+        self.assertTrue(self.profiler.features['opens_before']['rows'] >= len(self.rows))
+
+    def test_stream_rows_counted(self):
+        stream_rows = fg.Constants.STREAM_ROWS
+        fg.Constants.STREAM_ROWS = 7
+        try:
+            fg.gather_features_stream(self.conn.cursor(), self.rows)
+        finally:
+            fg.Constants.STREAM_ROWS = stream_rows
+        commands = self.conn.execute("SELECT COUNT(*) FROM commands").fetchone()[0]
+        self.assertTrue(self.profiler.features['stream_count_features']['rows'] >= commands)
+
+    def test_profile_written(self):
+        fg.gather_features_set(self.conn.cursor(), self.rows)
+        path = os.path.join(self.directory, 'profile.json')
+        with open(os.devnull, 'w') as out:
+            self.profiler.write(path, out)
+
+        with open(path) as f:
+            profile = json.load(f)
+        self.assertEqual(1, profile['features']['set_count_features']['calls'])
+        plans = [statement for statement in profile['statements'] if statement['plan']]
+        self.assertTrue(plans)
+        # the unprepared database has no indexes, so the set query scans the commands table
+        self.assertTrue(any(statement['full_scan'] for statement in plans))
+
+
+if __name__ == '__main__':
+    unittest.main()
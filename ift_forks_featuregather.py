@@ -6,9 +6,29 @@ This particular classifier creates features where we test numbers of instances
 before/after a fork."""
 
 import os
+import re
+import ast
+import sys
+import time
+import gzip
+import json
+import mmap
+import hashlib
 import datetime
+import struct
 import sqlite3
-from collections import OrderedDict
+import weakref
+import multiprocessing
+import BaseHTTPServer
+from array import array
+from itertools import chain, groupby, islice, izip, product, repeat
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class Constants:
@@ -21,17 +41,128 @@ class Constants:
     FORKEND = 30
     AFTER = 30
 
+    """Whether to output the attribute counts themselves"""
+    NUMERIC = True
+
     """Whether to output the attribute counts as binned nominal data"""
     CATEGORY = True
 
     """Whether to output the attribute counts as boolean nominal data"""
     BINARY = True
 
+    """The category map of a feature, by its name in relations(), for the features that should not use
+    DEFAULT_CATEGORY_MAP. A category map gives for the highest count of every category its label."""
+    CATEGORY_MAPS = {}
+
+    """The names of the features to extract (see feature_registry), or None for all of them. The queries of the
+    other features are not run."""
+    FEATURES = None
+
     """Whether to include two-factor interactions"""
     TWO_FACTOR = False
 
-    """Whether to output features based on Foraging Changes or on Forks"""
-    TRIGGER_EVENT = 'ForagingEnd' # (Foraging or Fork or ForagingEnd)
+    """Number of rows that are encoded and whose two-factor interactions are computed together (with NumPy when
+    it is installed)"""
+    BLOCK_ROWS = 1024
+
+    """Whether to output features based on Foraging Changes or on Forks. 'All' writes one file for each of them,
+    extracting the features of every trigger row once."""
+    TRIGGER_EVENT = 'ForagingEnd' # (Foraging or Fork or ForagingEnd or All)
+
+    """Whether to add epoch columns and indexes to the database before the run (see prepare_database). The
+    database is changed, but the queries become much faster."""
+    PREPARE = False
+
+    """How window counts are answered: 'sql' queries the database for every count, 'index' loads the
+    commands table into memory once and answers each count with binary searches, 'set' computes the features
+    of every trigger row with one query, 'plan' merges the counts of a trigger row into one grouped query per
+    window, 'stream' computes every trigger row in one pass over the commands without holding them in memory"""
+    ENGINE = 'sql' # (sql or index or set or plan or stream)
+
+    """Number of rows the 'stream' engine fetches from the database at a time"""
+    STREAM_ROWS = 10000
+
+    """Number of worker processes that extract features, each for a share of the participants. With 1 the
+    features are extracted in this process. The output is the same either way."""
+    WORKERS = 1
+
+    """Whether to write the ARFF file gzipped (Weka opens .arff.gz files directly)"""
+    GZIP = False
+
+    """Whether to write the data as sparse ARFF, where a row only has the values that are not the default of
+    their attribute (0, or the first nominal value), as {index value, ...}. None chooses sparse ARFF when fewer
+    than SPARSE_DENSITY of the values of the first SPARSE_SAMPLE rows are not the default. In sparse files the
+    binary attributes are declared as {False,True,None}, so that False is the default."""
+    SPARSE = False
+
+    """The share of values that are not the default below which SPARSE = None writes sparse ARFF"""
+    SPARSE_DENSITY = 0.3
+
+    """Number of rows whose values are measured when SPARSE is None"""
+    SPARSE_SAMPLE = 1000
+
+    """A directory to also write the feature matrix to as .npy column files, for reading with NumPy, or None.
+    See FeatureColumns."""
+    COLUMNS = None
+
+    """A localhost port to answer feature requests on instead of writing OUTFILE, or None. The database is read
+    into memory once and read again when its file changes. See FeatureService."""
+    SERVE = None
+
+    """Study databases to extract in one run instead of DB, as {"study": "path/to/study.sqlite", ...}, or None.
+    Each study is extracted by one of WORKERS processes and its participants are renamed study_participant (see
+    write_studies)."""
+    DATABASES = None
+
+    """Whether DATABASES are written to one ARFF file, or to one file for each study named after the study"""
+    MERGE = True
+
+    """Whether to report the number of rows done while the features are extracted"""
+    PROGRESS = False
+
+    """A grid of Constants to sweep, for example {'BEFORE': [-60, -30], 'AFTER': [30, 60]}. Every combination
+    is written to its own ARFF file, using one in-memory index of cumulative counts for all of them. None
+    makes a single run."""
+    SWEEP = None
+
+    """An SQLite file that keeps the counts of every trigger row between runs, or None for no cache. The counts
+    are keyed by the contents of the database and the feature definitions and windows, so only the encodings
+    (CATEGORY, BINARY, TWO_FACTOR) can change without counting again."""
+    CACHE = None
+
+    """The most trigger rows kept in the cache. The least recently used rows are removed first."""
+    CACHE_ROWS = 100000
+
+    """An ARFF file to keep up to date instead of writing a new OUTFILE, or None. Only the trigger rows that are
+    new or changed since the file was written are extracted; if the features, the header or the commands
+    changed, the whole file is made again. With GZIP, .gz is added to the path like to OUTFILE."""
+    INCREMENTAL = None
+
+    """A JSON file to write a profile of the run to, or None. The profile has the time, SQL statements, rows
+    and SQLite steps of every feature, and the query plan of every statement; a summary is written to stderr.
+    Only features extracted in this process are profiled."""
+    PROFILE = None
+
+    """A snapshot file of the commands and codes tables for the 'index' engine, or None. It is made from the
+    database the first time and again whenever the database changes; other runs and the workers map it instead of
+    reading the database. See EventStore."""
+    STORE = None
+
+    """A JSON file of more groups of EclipseCommands, as {"name": ["command", ...]}, or None. A group with the name
+    of one in the Groups class replaces it; every other group gets a name_before and a name_after feature."""
+    GROUPS = None
+
+    """Number of command n-grams to add as attributes, counted in the window before (BEFORE to FORKEND) and the
+    window after (FORKEND to AFTER) each trigger row, or 0 for none. The n-grams that happen most often in the
+    windows of all trigger rows are chosen. A command is its EclipseCommand when it has one."""
+    NGRAMS = 0
+
+    """The lengths of the n-grams"""
+    NGRAM_SIZES = [2, 3]
+
+
+"""Change this when the way a feature is counted changes, so that cached counts are not used any more."""
+FEATURES_VERSION = 2
 
 
 class Groups:
@@ -40,7 +171,6 @@ class Groups:
         'org.eclipse.search.ui.performTextSearchFile',
         'org.eclipse.search.ui.openSearchDialog',
         'org.eclipse.search.ui.openFileSearchPage',
-        'org.eclipse.search.ui.performTextSearchFile',
         'org.eclipse.search.ui.performTextSearchWorkspace',
         'org.eclipse.jdt.ui.edit.text.java.search.declarations.in.project',
         'org.eclipse.jdt.ui.edit.text.java.search.declarations.in.workspace'
@@ -55,6 +185,67 @@ class Groups:
         "org.eclipse.jdt.ui.JavaPerspective"]
 
 
+class SequencePattern(object):
+    """An "A then B" feature: the number of pairs of an anchor event that happens in the window of a trigger
+    row, followed by an event of the same participant that comes after the anchor and before the end of the
+    window. Anchors and the follower are (column, event) pairs, where column is 'command' or 'eclipsecommand'.
+    An anchor that is listed twice is counted twice."""
+
+    def __init__(self, anchors, follower):
+        self.anchors = tuple(anchors)
+        self.follower = follower
+
+    def key(self):
+        return (self.anchors, self.follower)
+
+
+_group_files = {}
+
+def groups():
+    """The groups of EclipseCommands by name, each a tuple without repeats: the groups of the Groups class and
+    those of the Constants.GROUPS file."""
+    definitions = OrderedDict((name, members) for name, members in sorted(vars(Groups).items())
+        if isinstance(members, list))
+
+    if Constants.GROUPS is not None:
+        definitions.update(group_file(Constants.GROUPS))
+
+    return OrderedDict((name, tuple(OrderedDict.fromkeys(members))) for name, members in definitions.iteritems())
+
+def file_stamp(path):
+    """The modification time and size of a file, which change when the file does."""
+    stat = os.stat(path)
+    return (stat.st_mtime, stat.st_size)
+
+def group_file(path):
+    """The groups of a Constants.GROUPS file. The file is read again when it has changed since it was read, so
+    that a long-lived process sees the edits."""
+    stamp = file_stamp(path)
+    if path not in _group_files or _group_files[path][0] != stamp:
+        with open(path) as f:
+            _group_files[path] = (stamp, json.load(f, object_pairs_hook=OrderedDict))
+    return _group_files[path][1]
+
+def group_members(name):
+    """The EclipseCommands of a group, without repeats."""
+    return groups()[name]
+
+def _event_condition(column, event):
+    """A condition that matches a column to an event, or to any of a tuple of events, and its parameters."""
+    if isinstance(event, tuple):
+        return column + " IN (" + ", ".join("?" * len(event)) + ")", list(event)
+    return column + " = ?", [event]
+
+def sequence_patterns():
+    """The declared sequence patterns. Add an entry here to make a new "A then B" feature."""
+    patterns = OrderedDict()
+    patterns['search_before_open'] = SequencePattern([('eclipsecommand', i) for i in group_members('search')],
+        ('command', 'FileOpenCommand'))
+    patterns['search_before_select'] = SequencePattern([('eclipsecommand', i) for i in group_members('search')],
+        ('command', 'SelectTextCommand'))
+    return patterns
+
+
 def num_to_bool(number):
     """Converts a number to a boolean, used to make a count into a exists/not exists."""
     if number == 0:
@@ -65,25 +256,57 @@ def num_to_bool(number):
         raise Exception("A natural number less than 0 is being converted to a bool.")
         return None
 
+"""The categories of a count, by the highest count of each category"""
+DEFAULT_CATEGORY_MAP = {0: "None", 1: "Few", 5: "Some", 9: "Many", 12: "Lots"}
+
+
+class BinTable(object):
+    """A category map compiled once: the highest counts of the categories in order and their labels. A count
+    goes in the first category whose highest count is at least the count; counts above the last one go in the
+    last category."""
+
+    _compiled = {}
+
+    def __init__(self, category_map):
+        self.thresholds = sorted(category_map.iterkeys())
+        self.labels = [category_map[threshold] for threshold in self.thresholds]
+
+    @classmethod
+    def compile(cls, category_map):
+        """The BinTable of a category map, compiled the first time it is asked for."""
+        key = tuple(sorted(category_map.iteritems()))
+        if key not in cls._compiled:
+            cls._compiled[key] = cls(category_map)
+        return cls._compiled[key]
+
+    def label(self, number):
+        return self.labels[min(bisect_left(self.thresholds, number), len(self.labels) - 1)]
+
+    def nominal_values(self):
+        """The labels in order, each once, for the ARFF header."""
+        values = []
+        for label in self.labels:
+            if label not in values:
+                values.append(label)
+        return values
+
 def num_to_categories(number, category_map = None):
     """Convert a number to a bin, used to make into a category.
     A bin_table is an OrderedDict of the actual range mapped to the result."""
 
     if category_map == None:
-        category_map = {0: "None", 1: "Few", 5: "Some", 9: "Many", 12: "Lots"}
+        category_map = DEFAULT_CATEGORY_MAP
 
-    for a_range in sorted(category_map.iterkeys()):
+    return BinTable.compile(category_map).label(number)
 
-        # Fix 16 isn't showing up as 'Lots' (in row 5)
-        if number > a_range:
-            pass
-        else:
-            return category_map[a_range]
+def category_tables():
+    """The BinTable of every feature of count_features, in order."""
+    return [BinTable.compile(Constants.CATEGORY_MAPS.get(name, DEFAULT_CATEGORY_MAP)) for name in relations()]
 
-    if number > max(category_map.keys()):
-        return category_map[max(category_map.keys())]
-    else:
-        return category_map[0]
+def encoding_configuration():
+    """Everything that decides how counts are encoded, to tell whether encoded rows can be reused."""
+    return [Constants.NUMERIC, Constants.CATEGORY, Constants.BINARY, [table.thresholds for table in category_tables()],
+        [table.labels for table in category_tables()]]
 
 def confirmed_forks(c):
     """Gets a list of forks that have a retrospective entry."""
@@ -101,31 +324,523 @@ def confirmed_foraging_end(c):
     foraging_end_query = "SELECT participant, videotime, foraging_end FROM codes"
     return c.execute(foraging_end_query)
 
-def num_commands_at_fork(c, fork_row, event, start, after):
-    """Gets the number of commands for a specified Command event 'start' seconds before the fork and 'after' seconds after the
-    start of the fork."""
-    q = "SELECT COUNT(*) FROM commands WHERE \
-        command = ? \
-        AND EXISTS \
-            (SELECT videotime FROM  \
-                (SELECT videotime FROM codes WHERE \
-                (participant = ? and videotime = ?)) \
-            AS times \
-            WHERE strftime('%s', commands.videotime) - strftime('%s', times.videotime) >= ?  \
-            AND strftime('%s', commands.videotime) - strftime('%s', times.videotime) <= ? \
-            AND participant = ?)"
-
-    return c.execute(q, (event,
-        fork_row['participant'], fork_row['videotime'],
-        start, after,
-        fork_row['participant'])).fetchone()[0]
-
+class EventIndex(object):
+    """An in-memory copy of the commands table. The epoch seconds of every command are kept in sorted lists per
+    participant, per (participant, command) and per (participant, eclipsecommand), so a window count is two binary
+    searches instead of a scan of the commands table.
+
+    Epoch seconds are computed by SQLite with the same strftime('%s', ...) as the queries (or read from the
+    epoch columns of a prepared database), so the counts are identical to the SQL ones."""
+
+    def __init__(self):
+        self.events = {}
+        self.commands = {}
+        self.eclipsecommands = {}
+        self.triggers = {}
+        self.sweeps = {}
+        self.groups = {}
+
+    @classmethod
+    def from_db(cls, c, participants=None):
+        """Reads the commands and codes tables once and builds the index, for all participants or only for the
+        listed ones."""
+        index = cls()
+        where, params = _participants_filter(participants)
+
+        commands_query = "SELECT participant, command, eclipsecommand, " + _epoch_sql(c, 'commands') + " AS seconds \
+            FROM commands WHERE seconds IS NOT NULL" + where + " ORDER BY seconds"
+        for participant, command, eclipsecommand, epoch in c.execute(commands_query, params):
+            index.add_event(participant, command, eclipsecommand, epoch)
+
+        codes_query = "SELECT participant, videotime, " + _epoch_sql(c, 'codes') + " AS seconds FROM codes \
+            WHERE seconds IS NOT NULL" + where
+        for participant, videotime, epoch in c.execute(codes_query, params):
+            index.triggers[(participant, videotime)] = epoch
+
+        return index
+
+    @classmethod
+    def from_store(cls, store, participants=None):
+        """Builds the index from an EventStore instead of the database, for all participants or only for the
+        listed ones. The epochs stay int32 columns: the slices of the store, and compact copies grouped by
+        command (see _group_epochs), which are searched where they are."""
+        index = cls()
+        for participant, epochs, commands, eclipsecommands in store.participant_columns(participants):
+            index.events[participant] = epochs
+            for code, times in _group_epochs(epochs, commands).iteritems():
+                index.commands[(participant, store.names[code])] = times
+            for code, times in _group_epochs(epochs, eclipsecommands).iteritems():
+                index.eclipsecommands[(participant, store.names[code])] = times
+
+        wanted = None if participants is None else set(participants)
+        for participant, videotime, epoch in store.triggers:
+            if wanted is None or participant in wanted:
+                index.triggers[(participant, videotime)] = epoch
+        return index
+
+    def add_event(self, participant, command, eclipsecommand, epoch):
+        """Adds one command. Events have to be added in order of their epoch."""
+        self.events.setdefault(participant, []).append(epoch)
+        if command is not None:
+            self.commands.setdefault((participant, command), []).append(epoch)
+        if eclipsecommand is not None:
+            self.eclipsecommands.setdefault((participant, eclipsecommand), []).append(epoch)
+
+    def trigger_epoch(self, fork_row):
+        """The epoch of a trigger row, or None if the row is not in the codes table."""
+        return self.triggers.get((fork_row['participant'], fork_row['videotime']))
+
+    def times(self, participant, column, event):
+        """The sorted epochs of the events of a participant's 'command' or 'eclipsecommand' column. The epochs of
+        a tuple of events are merged once and kept for later calls."""
+        if isinstance(event, tuple):
+            key = (participant, column, event)
+            if key not in self.groups:
+                self.groups[key] = sorted(t for member in event for t in self.times(participant, column, member))
+            return self.groups[key]
+        elif column == 'command':
+            return self.commands.get((participant, event), [])
+        elif column == 'eclipsecommand':
+            return self.eclipsecommands.get((participant, event), [])
+        else:
+            raise ValueError("Unknown commands column: %s" % column)
+
+    def count(self, column, event, fork_row, start, after):
+        """Counts the events of a 'command' or 'eclipsecommand' column that happen between 'start' and 'after'
+        seconds (inclusive) of the trigger row."""
+        epoch = self.trigger_epoch(fork_row)
+        if epoch is None:
+            return 0
+
+        times = self.times(fork_row['participant'], column, event)
+        return max(0, bisect_right(times, epoch + after) - bisect_left(times, epoch + start))
+
+    def exists(self, column, event, fork_row, start, after):
+        """Whether count would be more than 0, with one binary search."""
+        epoch = self.trigger_epoch(fork_row)
+        if epoch is None:
+            return False
+
+        times = self.times(fork_row['participant'], column, event)
+        first = bisect_left(times, epoch + start)
+        return first < len(times) and times[first] <= epoch + after
+
+    def sweep(self, pattern, participant):
+        """The anchors of a SequencePattern for a participant, the followers, and for every anchor the running
+        total of followers at or before the anchors so far. The totals come from one two-pointer sweep over the
+        two sorted lists and are kept for later calls."""
+        key = (pattern.key(), participant)
+        if key not in self.sweeps:
+            anchors = sorted(t for (column, event) in pattern.anchors for t in self.times(participant, column, event))
+            followers = self.times(participant, *pattern.follower)
+
+            totals = [0]
+            j = 0
+            for anchor in anchors:
+                while j < len(followers) and followers[j] <= anchor:
+                    j += 1
+                totals.append(totals[-1] + j)
+
+            self.sweeps[key] = (anchors, followers, totals)
+        return self.sweeps[key]
+
+    def pattern_count(self, pattern, fork_row, start, after):
+        """Counts the (anchor, follower) pairs of a SequencePattern for the trigger row. Every anchor between
+        'start' and 'after' seconds of the row is paired with the followers after it and before 'after'."""
+        epoch = self.trigger_epoch(fork_row)
+        if epoch is None:
+            return 0
+
+        anchors, followers, totals = self.sweep(pattern, fork_row['participant'])
+        first = bisect_left(anchors, epoch + start)
+        # An anchor at the end of the window has no follower before the end.
+        last = bisect_left(anchors, epoch + after)
+        if last <= first:
+            return 0
+
+        before_end = bisect_left(followers, epoch + after)
+        return (last - first) * before_end - (totals[last] - totals[first])
+
+    def pattern_counts(self, pattern, rows, start, after):
+        """pattern_count for every trigger row."""
+        return [self.pattern_count(pattern, row, start, after) for row in rows]
+
+
+def cumulative_counts(times):
+    """For a sorted list of epochs, the first second and an array with, for every second from the first to the
+    last, the number of epochs at or before it."""
+    if len(times) == 0:
+        return (0, array('i'))
+
+    first = int(times[0])
+    counts = array('i', [0]) * (int(times[-1]) - first + 1)
+    for t in times:
+        counts[t - first] += 1
+
+    running = 0
+    for i in xrange(len(counts)):
+        running += counts[i]
+        counts[i] = running
+    return (first, counts)
+
+def count_at_or_before(cumulative, second):
+    """The number of epochs at or before a second, from cumulative_counts."""
+    first, counts = cumulative
+    if not counts or second < first:
+        return 0
+    elif second - first >= len(counts):
+        return counts[-1]
+    else:
+        return counts[second - first]
+
+
+class PrefixIndex(EventIndex):
+    """An EventIndex that answers from cumulative counts for every second of the events, so that every window
+    count and sequence pattern count is a few array lookups, whatever the window. The cumulative counts are
+    made the first time an event is asked for and then shared by every window, which makes sweeps over many
+    window settings cost about as much as one run."""
+
+    def __init__(self):
+        EventIndex.__init__(self)
+        self.cumulative = {}
+
+    def cumulative_times(self, key, times):
+        if key not in self.cumulative:
+            self.cumulative[key] = cumulative_counts(times)
+        return self.cumulative[key]
+
+    def count(self, column, event, fork_row, start, after):
+        epoch = self.trigger_epoch(fork_row)
+        if epoch is None:
+            return 0
+
+        participant = fork_row['participant']
+        cumulative = self.cumulative_times((participant, column, event), self.times(participant, column, event))
+        return max(0, count_at_or_before(cumulative, epoch + after) - count_at_or_before(cumulative, epoch + start - 1))
+
+    def pattern_count(self, pattern, fork_row, start, after):
+        epoch = self.trigger_epoch(fork_row)
+        if epoch is None:
+            return 0
+
+        participant = fork_row['participant']
+        anchors, followers, totals = self.sweep(pattern, participant)
+        anchors = self.cumulative_times(('anchors', pattern.key(), participant), anchors)
+        followers = self.cumulative_times(('followers', pattern.key(), participant), followers)
+
+        first = count_at_or_before(anchors, epoch + start - 1)
+        last = count_at_or_before(anchors, epoch + after - 1)
+        if last <= first:
+            return 0
+
+        before_end = count_at_or_before(followers, epoch + after - 1)
+        return (last - first) * before_end - (totals[last] - totals[first])
+
+
+def _participants_filter(participants):
+    """The condition on the participant column that keeps only the listed participants (all when None), and its
+    parameters."""
+    if participants is None:
+        return "", ()
+    participants = list(participants)
+    return " AND participant IN (" + ", ".join("?" * len(participants)) + ")", participants
+
+def _group_epochs(epochs, codes):
+    """The epochs of every code of a column, in the order of the epochs, by code, as int32 arrays: slices of one
+    sorted copy with NumPy, arrays of the array module without. Code -1 (no value) is left out."""
+    if numpy is not None and isinstance(codes, numpy.ndarray):
+        if len(codes) == 0:
+            return {}
+        order = numpy.argsort(codes, kind='mergesort')
+        codes = codes[order]
+        epochs = epochs[order]
+        bounds = (numpy.flatnonzero(numpy.diff(codes)) + 1).tolist()
+        return dict((int(codes[start]), epochs[start:end])
+            for start, end in izip([0] + bounds, bounds + [len(codes)]) if codes[start] >= 0)
+
+    groups = {}
+    for epoch, code in izip(epochs, codes):
+        if code >= 0:
+            if code not in groups:
+                groups[code] = array('i')
+            groups[code].append(epoch)
+    return groups
+
+class MappedColumn(object):
+    """An int32 column of a memory map that is read where it is, for EventStore.load without NumPy. It is a
+    sequence that bisect can search and that slices (without a step) into other MappedColumns, so no part of
+    the column is copied until it is iterated over."""
+
+    def __init__(self, mapped, offset, length, byteorder=sys.byteorder):
+        self.mapped = mapped
+        self.offset = offset
+        self.length = length
+        self.byteorder = byteorder
+        self.format = ('<' if byteorder == 'little' else '>') + 'i'
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            start, stop, step = position.indices(self.length)
+            if step != 1:
+                raise ValueError("A MappedColumn cannot be sliced with a step")
+            return MappedColumn(self.mapped, self.offset + 4 * start, max(0, stop - start), self.byteorder)
+
+        if position < 0:
+            position += self.length
+        if not 0 <= position < self.length:
+            raise IndexError("MappedColumn index out of range")
+        return struct.unpack_from(self.format, self.mapped, self.offset + 4 * position)[0]
+
+    def __iter__(self):
+        for first in xrange(0, self.length, 4096):
+            last = min(first + 4096, self.length)
+            block = array('i', self.mapped[self.offset + 4 * first:self.offset + 4 * last])
+            if self.byteorder != sys.byteorder:
+                block.byteswap()
+            for value in block:
+                yield value
+
+def _padded(size):
+    """A size rounded up to a multiple of 8 bytes."""
+    return (size + 7) // 8 * 8
+
+
+class EventStore(object):
+    """A compact copy of the commands and codes tables. Command and EclipseCommand names are interned to integer
+    codes (-1 for none) and participants to their position in the sorted participant list, and the commands are
+    kept as four int32 columns sorted by participant and epoch: 'participants', 'epochs', 'commands' and
+    'eclipsecommands'. The codes rows are kept as (participant, videotime, epoch).
+
+    save() writes a snapshot file: a magic line, the length of a JSON header, the header (names, participants,
+    trigger rows, column offsets) and the columns. load() memory-maps it, so the columns are used where they are
+    in the file and shared by every process that maps it: as NumPy arrays, or as MappedColumns without NumPy."""
+
+    MAGIC = b"IFTSTOR1"
+    COLUMNS = ['participants', 'epochs', 'commands', 'eclipsecommands']
+
+    def __init__(self, names, participants, columns, triggers, source=None):
+        self.names = names
+        self.participants = participants
+        self.columns = columns
+        self.triggers = triggers
+        self.source = source
+
+    def __len__(self):
+        return len(self.columns['epochs'])
+
+    @classmethod
+    def from_db(cls, c, participants=None, source=None):
+        """Reads the commands and codes tables once, for all participants or only for the listed ones. 'source'
+        is saved with the store to tell which database it was made from."""
+        where, params = _participants_filter(participants)
+        codes = {}
+        names = []
+        participant_codes = {}
+        participant_list = []
+        columns = dict((name, array('i')) for name in cls.COLUMNS)
+
+        def intern(name):
+            if name is None:
+                return -1
+            if name not in codes:
+                codes[name] = len(names)
+                names.append(name)
+            return codes[name]
+
+        commands_query = "SELECT participant, command, eclipsecommand, " + _epoch_sql(c, 'commands') + " AS seconds \
+            FROM commands WHERE seconds IS NOT NULL" + where + " ORDER BY participant, seconds"
+        for participant, command, eclipsecommand, epoch in c.execute(commands_query, params):
+            if participant not in participant_codes:
+                participant_codes[participant] = len(participant_list)
+                participant_list.append(participant)
+            columns['participants'].append(participant_codes[participant])
+            columns['epochs'].append(epoch)
+            columns['commands'].append(intern(command))
+            columns['eclipsecommands'].append(intern(eclipsecommand))
+
+        codes_query = "SELECT participant, videotime, " + _epoch_sql(c, 'codes') + " AS seconds FROM codes \
+            WHERE seconds IS NOT NULL" + where
+        triggers = [tuple(row) for row in c.execute(codes_query, params)]
+        return cls(names, participant_list, columns, triggers, source)
+
+    def participant_columns(self, participants=None):
+        """Yields (participant, epochs, commands, eclipsecommands) with the slices of the columns of every
+        participant, or only of the listed ones."""
+        wanted = None if participants is None else set(participants)
+        column = self.columns['participants']
+        for code, participant in enumerate(self.participants):
+            if wanted is not None and participant not in wanted:
+                continue
+            first = bisect_left(column, code)
+            last = bisect_right(column, code)
+            yield (participant, self.columns['epochs'][first:last], self.columns['commands'][first:last],
+                self.columns['eclipsecommands'][first:last])
+
+    def save(self, path):
+        """Writes the snapshot file. It is written next to the path and renamed, so that a reader never maps half
+        a snapshot."""
+        layout = []
+        offset = 0
+        for name in self.COLUMNS:
+            layout.append([name, offset])
+            offset += _padded(4 * len(self))
+
+        header = json.dumps({'names': self.names, 'participants': self.participants, 'triggers': self.triggers,
+            'source': self.source, 'length': len(self), 'byteorder': sys.byteorder, 'columns': layout})
+        start = _padded(len(self.MAGIC) + 8 + len(header))
+
+        with open(path + ".tmp", 'wb') as f:
+            f.write(self.MAGIC + struct.pack('<Q', len(header)) + header)
+            f.write(b" " * (start - f.tell()))
+            for name in self.COLUMNS:
+                data = self.columns[name].astype('int32').tostring() if numpy is not None and \
+                    isinstance(self.columns[name], numpy.ndarray) else self.columns[name].tostring()
+                f.write(data + b"\0" * (_padded(len(data)) - len(data)))
+        os.rename(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        """Maps a snapshot file written by save()."""
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mapped[:len(cls.MAGIC)] != cls.MAGIC:
+            raise ValueError("Not an event store snapshot: %s" % path)
+        size, = struct.unpack('<Q', mapped[len(cls.MAGIC):len(cls.MAGIC) + 8])
+        header = json.loads(mapped[len(cls.MAGIC) + 8:len(cls.MAGIC) + 8 + size])
+        start = _padded(len(cls.MAGIC) + 8 + size)
+        dtype = ('<' if header['byteorder'] == 'little' else '>') + 'i4'
+
+        columns = {}
+        for name, offset in header['columns']:
+            if numpy is not None:
+                columns[name] = numpy.frombuffer(mapped, dtype, header['length'], start + offset)
+            else:
+                columns[name] = MappedColumn(mapped, start + offset, header['length'], header['byteorder'])
+
+        return cls(header['names'], header['participants'], columns,
+            [tuple(trigger) for trigger in header['triggers']], header['source'])
+
+def snapshot_store(c, path, db):
+    """The EventStore of a database, mapped from its snapshot file. The snapshot is made again when it was made
+    from a different database or the database has changed since (see database_stamp)."""
+    source = database_stamp(db)
+    if os.path.exists(path):
+        store = EventStore.load(path)
+        if store.source == source:
+            return store
+
+    store = EventStore.from_db(c, source=source)
+    store.save(path)
+    return store
+
+
+_event_index = None
+
+def use_event_index(index):
+    """Answers num_commands_at_fork and num_eclipsecommands_at_fork from an EventIndex. Pass None to go back
+    to querying the database."""
+    global _event_index
+    _event_index = index
+
+def _column_exists(c, table, column):
+    return column in [info[1] for info in c.execute("PRAGMA table_info(%s)" % table).fetchall()]
+
+def stale_epoch_rows(c):
+    """The number of commands and codes rows whose epoch column does not match their videotime, or None if
+    the database has not been prepared."""
+    if not (_column_exists(c, 'commands', 'epoch') and _column_exists(c, 'codes', 'epoch')):
+        return None
 
-def num_eclipsecommands_at_fork(c, fork_row, event, start, after):
-    """Gets the number of commands for a specified EclipseCommand event 'start' seconds before the fork and 'after' seconds after the
-    start of the fork."""
-    q = "SELECT COUNT(*) FROM commands WHERE \
-        eclipsecommand = ? \
+    stale = 0
+    for table in ('commands', 'codes'):
+        stale += c.execute("SELECT COUNT(*) FROM " + table + " \
+            WHERE epoch IS NOT CAST(strftime('%s', videotime) AS INTEGER)").fetchone()[0]
+    return stale
+
+EPOCH_TRIGGERS = ['commands_epoch_insert', 'commands_epoch_update', 'codes_epoch_insert', 'codes_epoch_update']
+
+_epoch_columns = weakref.WeakKeyDictionary()
+
+def epoch_triggers_installed(c):
+    """Whether prepare_database has installed the triggers that keep the epoch columns up to date."""
+    return c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (?, ?, ?, ?)",
+        EPOCH_TRIGGERS).fetchone()[0] == len(EPOCH_TRIGGERS)
+
+def epoch_columns_ready(c):
+    """Whether the queries can use the epoch columns made by prepare_database. As its triggers keep every row up
+    to date, this only looks at the schema; a preparation without them is not used. The answer is kept for a
+    connection of connect(), and a plain sqlite3.Connection (which cannot be weakly referenced) asks sqlite_master
+    each time."""
+    conn = c.connection
+    try:
+        ready = _epoch_columns.get(conn)
+    except TypeError:
+        return epoch_triggers_installed(c)
+
+    if ready is None:
+        ready = _epoch_columns[conn] = epoch_triggers_installed(c)
+    return ready
+
+def prepare_database(conn):
+    """Adds an integer epoch column (the seconds of strftime('%s', videotime)) to the commands and codes tables
+    and indexes the commands by participant and epoch, so that the window queries do not have to parse every
+    videotime. Triggers set the epoch of every row that is inserted or whose videotime changes afterwards. Running
+    it again only updates the rows that became stale since the last time."""
+    c = conn.cursor()
+    for table in ('commands', 'codes'):
+        if not _column_exists(c, table, 'epoch'):
+            c.execute("ALTER TABLE " + table + " ADD COLUMN epoch INTEGER")
+        c.execute("UPDATE " + table + " SET epoch = CAST(strftime('%s', videotime) AS INTEGER) \
+            WHERE epoch IS NOT CAST(strftime('%s', videotime) AS INTEGER)")
+        update = "UPDATE " + table + " SET epoch = CAST(strftime('%s', NEW.videotime) AS INTEGER) \
+            WHERE rowid = NEW.rowid; END"
+        c.execute("CREATE TRIGGER IF NOT EXISTS " + table + "_epoch_insert AFTER INSERT ON " + table + " BEGIN " +
+            update)
+        c.execute("CREATE TRIGGER IF NOT EXISTS " + table + "_epoch_update AFTER UPDATE OF videotime, epoch ON " +
+            table + " BEGIN " + update)
+
+    c.execute("CREATE INDEX IF NOT EXISTS commands_participant_epoch ON commands (participant, epoch)")
+    c.execute("CREATE INDEX IF NOT EXISTS commands_participant_command_epoch \
+        ON commands (participant, command, epoch)")
+    c.execute("CREATE INDEX IF NOT EXISTS commands_participant_eclipsecommand_epoch \
+        ON commands (participant, eclipsecommand, epoch)")
+    c.execute("CREATE INDEX IF NOT EXISTS codes_participant_videotime_epoch ON codes (participant, videotime, epoch)")
+    conn.commit()
+
+    try:
+        _epoch_columns[conn] = True
+    except TypeError:
+        pass
+
+def _epoch_sql(c, table):
+    """The epoch seconds of a table's videotime, from the epoch column when the database is prepared."""
+    if epoch_columns_ready(c):
+        return table + ".epoch"
+    else:
+        return "CAST(strftime('%s', " + table + ".videotime) AS INTEGER)"
+
+def _window_query(c, select, column, fork_row, event, start, after):
+    """A query that selects the commands whose 'command' or 'eclipsecommand' column is the event (or one of a
+    tuple of events) and that happen between 'start' and 'after' seconds (inclusive) of the trigger row, and its
+    parameters."""
+    condition, events = _event_condition(column, event)
+    if epoch_columns_ready(c):
+        q = "SELECT " + select + " FROM commands WHERE \
+            participant = ? AND " + condition + " \
+            AND epoch BETWEEN \
+                (SELECT epoch FROM codes WHERE participant = ? AND videotime = ? LIMIT 1) + ? \
+                AND (SELECT epoch FROM codes WHERE participant = ? AND videotime = ? LIMIT 1) + ?"
+
+        return q, tuple([fork_row['participant']] + events + [
+            fork_row['participant'], fork_row['videotime'], start,
+            fork_row['participant'], fork_row['videotime'], after])
+
+    q = "SELECT " + select + " FROM commands WHERE \
+        " + condition + " \
         AND EXISTS \
             (SELECT videotime FROM  \
                 (SELECT videotime FROM codes WHERE \
@@ -135,173 +850,275 @@ def num_eclipsecommands_at_fork(c, fork_row, event, start, after):
             AND strftime('%s', commands.videotime) - strftime('%s', times.videotime) <= ? \
             AND participant = ?)"
 
-    return c.execute(q, (event,
+    return q, tuple(events + [
         fork_row['participant'], fork_row['videotime'],
         start, after,
-        fork_row['participant'])).fetchone()[0]
-
-def num_search_before_select(c, fork_row, start, after):
-    """Counts the number of SelectTextCommands that occur after a search before a fork."""
-    exists = 0
-
-    q = "SELECT * FROM commands WHERE \
-        eclipsecommand = ? \
-        AND EXISTS \
-            (SELECT videotime FROM  \
-                (SELECT videotime FROM codes WHERE \
-                (participant = ? and videotime = ?)) \
-            AS times \
-            WHERE strftime('%s', commands.videotime) - strftime('%s', times.videotime) >= ?  \
-            AND strftime('%s', commands.videotime) - strftime('%s', times.videotime) <= ? \
-            AND participant = ?)"
-
-    r = "SELECT * FROM commands WHERE command = 'SelectTextCommand' \
-        AND strftime('%s', commands.videotime) - strftime('%s', ?) > 0 \
-        AND strftime('%s', commands.videotime) - strftime('%s', ?) < ?"
+        fork_row['participant']])
+
+def _following_query(c, column, event, fork_row, anchor_row, after):
+    """A query for the participant's commands of an event that come after an anchor's videotime and less than
+    'after' seconds after the trigger row's videotime, and its parameters."""
+    if epoch_columns_ready(c):
+        q = "SELECT * FROM commands WHERE participant = ? AND " + column + " = ? \
+            AND epoch > CAST(strftime('%s', ?) AS INTEGER) \
+            AND epoch < CAST(strftime('%s', ?) AS INTEGER) + ?"
+    else:
+        q = "SELECT * FROM commands WHERE participant = ? AND " + column + " = ? \
+            AND strftime('%s', commands.videotime) - strftime('%s', ?) > 0 \
+            AND strftime('%s', commands.videotime) - strftime('%s', ?) < ?"
 
-    for i in Groups.search:
-        result_set_forks = c.execute(q, (i,
-            fork_row['participant'], fork_row['videotime'],
-            start, after,
-            fork_row['participant']))
+    return q, (fork_row['participant'], event, anchor_row['videotime'], fork_row['videotime'], after)
 
-        for j in result_set_forks:
-            search_time = j['videotime']
+TRIGGER_EVENTS = ['Fork', 'Foraging', 'ForagingEnd']
 
-            result_set_opens = c.execute(r, (search_time, fork_row['videotime'], after))
-            for k in result_set_opens:
-                exists += 1
+def trigger_rows(c, event):
+    """The rows of the codes table that are classified for the event."""
+    if event == 'Fork':
+        return confirmed_forks(c)
+    elif event == 'Foraging':
+        return confirmed_foraging_changes(c)
+    elif event == 'ForagingEnd':
+        return confirmed_foraging_end(c)
+    else:
+        raise ValueError("Unknown trigger event: %s" % event)
 
-    return exists
+def num_commands_at_fork(c, fork_row, event, start, after):
+    """Gets the number of commands for a specified Command event 'start' seconds before the fork and 'after' seconds after the
+    start of the fork."""
+    if _event_index is not None:
+        return _event_index.count('command', event, fork_row, start, after)
 
-def num_search_before_open(c, fork_row, start, after):
-    """Counts the number of FileOpenCommands that occur after a search before a fork."""
-    exists = 0
+    q, params = _window_query(c, "COUNT(*)", 'command', fork_row, event, start, after)
+    return c.execute(q, params).fetchone()[0]
 
-    q = "SELECT * FROM commands WHERE \
-        eclipsecommand = ? \
-        AND EXISTS \
-            (SELECT videotime FROM  \
-                (SELECT videotime FROM codes WHERE \
-                (participant = ? and videotime = ?)) \
-            AS times \
-            WHERE strftime('%s', commands.videotime) - strftime('%s', times.videotime) >= ?  \
-            AND strftime('%s', commands.videotime) - strftime('%s', times.videotime) <= ? \
-            AND participant = ?)"
 
-    r = "SELECT * FROM commands WHERE command = 'FileOpenCommand' \
-        AND strftime('%s', commands.videotime) - strftime('%s', ?) > 0 \
-        AND strftime('%s', commands.videotime) - strftime('%s', ?) < ?"
+def num_eclipsecommands_at_fork(c, fork_row, event, start, after):
+    """Gets the number of commands for a specified EclipseCommand event 'start' seconds before the fork and 'after' seconds after the
+    start of the fork."""
+    if _event_index is not None:
+        return _event_index.count('eclipsecommand', event, fork_row, start, after)
 
-    for i in Groups.search:
-        result_set_forks = c.execute(q, (i,
-            fork_row['participant'], fork_row['videotime'],
-            start, after,
-            fork_row['participant']))
+    q, params = _window_query(c, "COUNT(*)", 'eclipsecommand', fork_row, event, start, after)
+    return c.execute(q, params).fetchone()[0]
 
-        for j in result_set_forks:
-            search_time = j['videotime']
+def num_pattern_at_fork(c, fork_row, pattern, start, after):
+    """Counts the (anchor, follower) pairs of a SequencePattern, where the anchors occur 'start' to 'after' seconds
+    from the fork and the followers come after them, less than 'after' seconds from the fork."""
+    if _event_index is not None:
+        return _event_index.pattern_count(pattern, fork_row, start, after)
 
-            result_set_opens = c.execute(r, (search_time, fork_row['videotime'], after))
+    exists = 0
+    for column, events, times in _anchor_columns(pattern):
+        q, params = _window_query(c, "*", column, fork_row, events, start, after)
+        result_set_forks = c.execute(q, params)
+
+        # Fetch the anchors first: running r on the same cursor would end this loop after the first anchor.
+        for j in result_set_forks.fetchall():
+            r, params = _following_query(c, pattern.follower[0], pattern.follower[1], fork_row, j, after)
+            result_set_opens = c.execute(r, params)
             for k in result_set_opens:
-                exists += 1
+                exists += times[j[column]]
 
     return exists
 
+def _anchor_columns(pattern):
+    """The anchors of a SequencePattern by column: (column, events, times) where 'events' is a tuple of the
+    column's anchors and 'times' how often each of them is listed."""
+    columns = []
+    for column in ('command', 'eclipsecommand'):
+        times = OrderedDict()
+        for anchor_column, event in pattern.anchors:
+            if anchor_column == column:
+                times[event] = times.get(event, 0) + 1
+        if times:
+            columns.append((column, tuple(times), times))
+    return columns
+
+def existence_only():
+    """Whether the run only outputs whether each feature happened (the boolean attributes), so that counting can
+    stop at the first event."""
+    return Constants.BINARY and not (Constants.NUMERIC or Constants.CATEGORY or Constants.TWO_FACTOR)
+
+def pattern_exists(c, fork_row, pattern, start, after):
+    """Whether num_pattern_at_fork would be more than 0, stopping at the first (anchor, follower) pair."""
+    if _event_index is not None:
+        return _event_index.pattern_count(pattern, fork_row, start, after) > 0
+
+    for column, events, times in _anchor_columns(pattern):
+        q, params = _window_query(c, "*", column, fork_row, events, start, after)
+        for j in c.execute(q, params).fetchall():
+            r, params = _following_query(c, pattern.follower[0], pattern.follower[1], fork_row, j, after)
+            if c.execute(r + " LIMIT 1", params).fetchone() is not None:
+                return True
+    return False
+
+def term_exists(c, fork_row, kind, event, start, after):
+    """Whether a term of feature_terms has at least one event for the trigger row, with a LIMIT 1 query or one
+    probe of the EventIndex."""
+    if kind == 'pattern':
+        return pattern_exists(c, fork_row, sequence_patterns()[event], start, after)
+    if _event_index is not None:
+        return _event_index.exists(kind, event, fork_row, start, after)
+
+    q, params = _window_query(c, "1", kind, fork_row, event, start, after)
+    return c.execute(q + " LIMIT 1", params).fetchone() is not None
+
+def _feature_exists(c, fork_row, terms):
+    return int(any(term_exists(c, fork_row, *term) for term in terms))
+
+def exists_features(c, fork_row):
+    """count_features for a run that only needs existence_only(): 1 for each feature that has an event of any
+    of its terms, else 0. The terms are tried in order and the first event ends the feature."""
+    return [profile_call(name, _feature_exists, c, fork_row, terms) for name, terms in feature_terms().iteritems()]
 
-def num_commands_before(c, fork_row, event):
-    """Finds the specified commands that occur 60 seconds before the start of the fork segment
-    (that is, the two segments before the fork segment)."""
-    return num_commands_at_fork(c, fork_row, event, -60, 0)
-
-
-def num_commands_after(c, fork_row, event):
-    """Finds the specified commands that occur 60 seconds after the start of the fork segment (that is,
-    the fork segment itself and the next segment after.)"""
-    return num_commands_at_fork(c, fork_row, event, 0, 60)
-
-def num_eclipsecommands_before(c, fork_row, event):
-    """Finds the specified commands that occur 60 seconds before the start of the fork segment
-    (that is, the two segments before the fork segment)."""
-    return num_eclipsecommands_at_fork(c, fork_row, event, -60, 0)
-
+def num_search_before_select(c, fork_row, start, after):
+    """Counts the number of SelectTextCommands that occur after a search before a fork."""
+    return num_pattern_at_fork(c, fork_row, sequence_patterns()['search_before_select'], start, after)
 
-def num_eclipsecommands_after(c, fork_row, event):
-    """Finds the specified commands that occur 60 seconds after the start of the fork segment (that is,
-    the fork segment itself and the next segment after.)"""
-    return num_eclipsecommands_at_fork(c, fork_row, event, 0, 60)
+def num_search_before_open(c, fork_row, start, after):
+    """Counts the number of FileOpenCommands that occur after a search before a fork."""
+    return num_pattern_at_fork(c, fork_row, sequence_patterns()['search_before_open'], start, after)
 
 
 def num_editing_before(c, fork_row):
-    """Finds the commands related to editing before the fork"""
-    b = Constants.BEFORE
-    a = Constants.FORKEND
-    return num_commands_at_fork(c, fork_row, 'Insert', b, a) \
-        + num_commands_at_fork(c, fork_row, 'Delete', b, a) \
-        + num_commands_at_fork(c, fork_row, 'Replace', b, a) \
-        + num_commands_at_fork(c, fork_row, 'UndoCommand', b, a)
-
+    """Finds the commands related to editing before the fork (the edits_before feature)"""
+    return feature_registry()['edits_before'].count(c, fork_row)
 
 def num_editing_after(c, fork_row):
-    """Finds the commands related to editin after the fork"""
-    b = Constants.FORKEND
-    a = Constants.AFTER
-    return num_commands_at_fork(c, fork_row, 'Insert', b, a) \
-        + num_commands_at_fork(c, fork_row, 'Delete', b, a) \
-        + num_commands_at_fork(c, fork_row, 'Replace', b, a) \
-        + num_commands_at_fork(c, fork_row, 'UndoCommand', b, a)    
+    """Finds the commands related to editing after the fork (the edits_after feature)"""
+    return feature_registry()['edits_after'].count(c, fork_row)
 
 def num_debugging_before(c, fork_row):
-    """Debugging commands before a fork"""
-    b = Constants.BEFORE
-    a = Constants.FORKEND
-
-    total = 0
-    for i in Groups.debugging_eclipsecommands:
-        total += num_eclipsecommands_at_fork(c, fork_row, i, b, a)
-
-    return total
+    """Debugging commands before a fork (the debugging_before feature)"""
+    return feature_registry()['debugging_before'].count(c, fork_row)
 
 def num_debugging_after(c, fork_row):
-    """Debugging commands after a fork"""
-    b = Constants.FORKEND
-    a = Constants.AFTER
+    """Debugging commands after a fork (the debugging_after feature)"""
+    return feature_registry()['debugging_after'].count(c, fork_row)
 
-    total = 0
-    for i in Groups.debugging_eclipsecommands:
-        total += num_eclipsecommands_at_fork(c, fork_row, i, b, a)    
+def num_searching_before(c, fork_row):
+    """Finds the search commands before the fork (the searching_before feature)"""
+    return feature_registry()['searching_before'].count(c, fork_row)
 
-    return total
+def num_searching_after(c, fork_row):
+    """Finds the search commands after the fork (the searching_after feature)"""
+    return feature_registry()['searching_after'].count(c, fork_row)
 
 def event_ordering(c, fork_row):
-    pass
-
-class ForkException(Exception):
-    pass
-
-
-def num_searching_before(c, fork_row):
-    """Finds the commands related to editing before the fork"""
-    b = Constants.BEFORE
-    a = Constants.FORKEND
-    
-    total = 0
-    for i in Groups.search:
-        total += num_eclipsecommands_at_fork(c, fork_row, i, b, a)
-
-    return total
+    """The n-grams of commands in the windows before and after the fork, as a dictionary of counts for each
+    window (see ngram_counts)."""
+    return ngram_counts(c, [fork_row], ngram_windows(), Constants.NGRAM_SIZES)[0]
+
+def ngram_windows():
+    """The windows whose n-grams are counted: before and after the fork."""
+    return [(Constants.BEFORE, Constants.FORKEND), (Constants.FORKEND, Constants.AFTER)]
+
+
+class RollingNgrams(object):
+    """The counts of the n-grams of a participant's commands from position 'first' up to (not including) 'last'
+    of the list of commands. The window only moves forward: the n-grams that come into it are added and the ones
+    that leave it are taken away, so consecutive triggers do not count their windows again."""
+
+    def __init__(self, tokens, sizes):
+        self.tokens = tokens
+        self.sizes = sizes
+        self.first = 0
+        self.last = 0
+        self.counts = {}
+
+    def _add(self, start, size, amount):
+        gram = tuple(self.tokens[start:start + size])
+        count = self.counts.get(gram, 0) + amount
+        if count:
+            self.counts[gram] = count
+        else:
+            del self.counts[gram]
+
+    def move(self, first, last):
+        """Moves the window to the commands from 'first' up to 'last'. Neither may be less than before."""
+        for size in self.sizes:
+            for end in xrange(self.last, last):
+                if end - size + 1 >= self.first:
+                    self._add(end - size + 1, size, 1)
+        for size in self.sizes:
+            for start in xrange(self.first, first):
+                if start + size <= last:
+                    self._add(start, size, -1)
+        self.first = first
+        self.last = last
+
+
+def ngram_counts(c, rows, windows, sizes):
+    """For every trigger row, a dictionary of the counts of the n-grams of commands in each (start, after) window,
+    an n-gram being a tuple of consecutive commands that are all in the window. The commands of one participant
+    at a time are read, in order of time, and the windows roll over the participant's triggers in order."""
+    where, params = _participants_filter(set(row['participant'] for row in rows))
+    wanted = set((row['participant'], row['videotime']) for row in rows)
+
+    triggers = {}
+    codes_query = "SELECT participant, videotime, " + _epoch_sql(c, 'codes') + " AS seconds FROM codes \
+        WHERE seconds IS NOT NULL" + where
+    for participant, videotime, epoch in c.execute(codes_query, params).fetchall():
+        if (participant, videotime) in wanted:
+            triggers.setdefault(participant, {}).setdefault(videotime, epoch)
+
+    results = {}
+    commands_query = "SELECT participant, command, eclipsecommand, " + _epoch_sql(c, 'commands') + " AS seconds \
+        FROM commands WHERE seconds IS NOT NULL" + where + " ORDER BY participant, seconds, rowid"
+    for participant, events in groupby(c.execute(commands_query, params), lambda event: event[0]):
+        # A command with neither a command nor an eclipsecommand has no token, so it is not part of any n-gram.
+        events = [event for event in events if event[1] is not None or event[2] is not None]
+        epochs = [event[3] for event in events]
+        tokens = [event[2] if event[2] is not None else event[1] for event in events]
+
+        rolling = [RollingNgrams(tokens, sizes) for window in windows]
+        for epoch, videotime in sorted((epoch, videotime) for videotime, epoch in triggers.get(participant, {}).items()):
+            window_counts = []
+            for ngrams, (start, after) in izip(rolling, windows):
+                ngrams.move(bisect_left(epochs, epoch + start), bisect_right(epochs, epoch + after))
+                window_counts.append(dict(ngrams.counts))
+            results[(participant, videotime)] = window_counts
+
+    return [results.get((row['participant'], row['videotime']), [{} for window in windows]) for row in rows]
+
+
+class NgramTable(object):
+    """The n-grams chosen as attributes and, for every trigger row, the count of each n-gram in each window, in
+    the order of the attributes."""
+
+    def __init__(self, grams, counts):
+        self.grams = grams
+        self.counts = counts
+
+    def select(self, positions):
+        """The table of some of the rows."""
+        return NgramTable(self.grams, [self.counts[position] for position in positions])
+
+def ngram_table(c, rows):
+    """The NgramTable of the trigger rows, with the Constants.NGRAMS n-grams that happen most often in all the
+    windows, or None when NGRAMS is 0."""
+    if not Constants.NGRAMS:
+        return None
+    return top_ngrams(ngram_counts(c, rows, ngram_windows(), Constants.NGRAM_SIZES))
 
+def top_ngrams(counts):
+    """The NgramTable of the counts of ngram_counts, with the Constants.NGRAMS n-grams that happen most often."""
+    totals = {}
+    for row_counts in counts:
+        for window_counts in row_counts:
+            for gram, count in window_counts.iteritems():
+                totals[gram] = totals.get(gram, 0) + count
 
-def num_searching_after(c, fork_row):
-    """Finds the commands related to editin after the fork"""
-    b = Constants.FORKEND
-    a = Constants.AFTER
+    grams = sorted(totals, key=lambda gram: (-totals[gram], gram))[:Constants.NGRAMS]
+    return NgramTable(grams, [[window_counts.get(gram, 0) for gram in grams for window_counts in row_counts]
+        for row_counts in counts])
 
-    total = 0
-    for i in Groups.search:
-        total += num_eclipsecommands_at_fork(c, fork_row, i, b, a)
+def ngram_names(grams):
+    """The attribute names of the n-grams, in the order of the counts of NgramTable."""
+    return ["ngram__" + "-then-".join(gram) + "__" + window for gram in grams for window in ('before', 'after')]
 
-    return total
+class ForkException(Exception):
+    pass
 
 
 def coded_as_fork(fork_row):
@@ -336,76 +1153,927 @@ def coded_as_foraging_end(fork_row):
         return "NotForagingEnd"
 
 def make_features_into_categories(attributes):
-    categories = []
-    for attribute in attributes:
-        categories.append(num_to_categories(attribute))
-    return categories
+    return categories_matrix([attributes])[0]
 
 def make_features_into_booleans(attributes):
-    booleans = []
-    for attribute in attributes:
-        booleans.append(num_to_bool(attribute))
-    return booleans
-
-def gather_features(c, fork_row):
-    """A list of the features"""
-    # participant = str(fork_row['participant'])
-    # videotime = fork_row['videotime']
-
-    attributes = [
-        # participant,
-        # videotime,
-        num_commands_before(c, fork_row, 'FileOpenCommand'),
-        num_commands_after(c, fork_row, 'FileOpenCommand'),
-        num_commands_before(c, fork_row, 'SelectTextCommand'),
-        num_commands_after(c, fork_row, 'SelectTextCommand'),
-        num_editing_before(c, fork_row),
-        num_editing_after(c, fork_row),
-        num_searching_before(c, fork_row),
-        num_searching_after(c, fork_row),
-        num_eclipsecommands_before(c, fork_row, 'org.eclipse.jdt.ui.edit.text.java.search.references.in.workspace') \
-            + num_eclipsecommands_before(c, fork_row, 'org.eclipse.jdt.ui.edit.text.java.search.references.in.project'),
-        num_eclipsecommands_after(c, fork_row, 'org.eclipse.jdt.ui.edit.text.java.search.references.in.workspace') \
-            + num_eclipsecommands_before(c, fork_row, 'org.eclipse.jdt.ui.edit.text.java.search.references.in.project'),
-        num_debugging_before(c, fork_row),
-        num_debugging_after(c, fork_row),
-        num_commands_before(c, fork_row, 'RunCommand'),
-        num_commands_after(c, fork_row, 'RunCommand'),
-        num_search_before_open(c, fork_row, Constants.BEFORE, Constants.FORKEND),
-        num_search_before_select(c, fork_row, Constants.FORKEND, Constants.AFTER)
-    ]
-
-    # Gather all of the attributes again, but put them into categories.
-    categories = []
-    if Constants.CATEGORY:
-        categories += make_features_into_categories(attributes)
-
-    booleans = []
-    if Constants.BINARY:
-        booleans += make_features_into_booleans(attributes) 
+    return booleans_matrix([attributes])[0]
+
+def categories_matrix(matrix):
+    """The categories of every count of a matrix of count rows. The columns that share a BinTable are binned
+    together, with numpy.searchsorted when NumPy is there."""
+    tables = category_tables()
+    columns = OrderedDict()
+    for position, table in enumerate(tables):
+        columns.setdefault(table, []).append(position)
+
+    categories = [[None] * len(tables) for row in matrix]
+    if numpy is not None and matrix:
+        counts = numpy.asarray(matrix)
+        for table, positions in columns.iteritems():
+            bins = numpy.searchsorted(table.thresholds, counts[:, positions], side='left')
+            labels = numpy.array(table.labels, dtype=object)[numpy.minimum(bins, len(table.labels) - 1)].tolist()
+            for row, row_labels in izip(categories, labels):
+                for position, label in izip(positions, row_labels):
+                    row[position] = label
+        return categories
+
+    for row, counts in izip(categories, matrix):
+        for position, (table, count) in enumerate(izip(tables, counts)):
+            row[position] = table.label(count)
+    return categories
 
-    if Constants.CATEGORY:
-        attributes += categories
+def booleans_matrix(matrix):
+    """Whether every count of a matrix of count rows is more than 0."""
+    if numpy is not None and matrix:
+        counts = numpy.asarray(matrix)
+        if (counts < 0).any():
+            raise Exception("A natural number less than 0 is being converted to a bool.")
+        return (counts != 0).tolist()
+    return [[num_to_bool(count) for count in counts] for counts in matrix]
+
+def encode_matrix(matrix):
+    """encode_features for every row of a matrix of count rows, binning the whole matrix at once."""
+    matrix = [list(counts) for counts in matrix]
+    categories = categories_matrix(matrix) if Constants.CATEGORY else [[] for counts in matrix]
+    booleans = booleans_matrix(matrix) if Constants.BINARY else [[] for counts in matrix]
+    return [counts + row_categories + row_booleans
+        for counts, row_categories, row_booleans in izip(matrix, categories, booleans)]
+
+class Feature(object):
+    """A feature of count_features: its name in the ARFF header, its ARFF type and the window counts (kind, event,
+    start, after) that it is the sum of (see feature_terms). Every engine counts it from its terms."""
+
+    def __init__(self, name, type, terms):
+        self.name = name
+        self.type = type
+        self.terms = terms
+
+    def count(self, c, fork_row):
+        """The feature for a trigger row with queries (or the EventIndex), one for each term."""
+        return sum(count_term(c, fork_row, *term) for term in self.terms)
+
+def count_term(c, fork_row, kind, event, start, after):
+    """One term of feature_terms for a trigger row."""
+    if kind == 'command':
+        return num_commands_at_fork(c, fork_row, event, start, after)
+    elif kind == 'eclipsecommand':
+        return num_eclipsecommands_at_fork(c, fork_row, event, start, after)
+    elif kind == 'pattern':
+        return num_pattern_at_fork(c, fork_row, sequence_patterns()[event], start, after)
+    else:
+        raise ValueError("Unknown kind of term: %s" % kind)
+
+def _registry_key():
+    """Everything feature_registry depends on, to tell when it has to be built again."""
+    group_stamp = file_stamp(Constants.GROUPS) if Constants.GROUPS is not None else None
+    class_groups = [(name, tuple(members)) for name, members in sorted(vars(Groups).items())
+        if isinstance(members, list)]
+    return (Constants.BEFORE, Constants.FORKEND, Constants.AFTER, Constants.GROUPS, group_stamp, class_groups)
+
+_registry = {}
+
+def feature_registry():
+    """Every feature there is, in the order of the ARFF columns. The header, the counting of every engine and
+    feature_terms all come from here, so a feature only has to be declared once. The registry is built again
+    only when the windows or the groups change."""
+    key = _registry_key()
+    if _registry.get('key') != key:
+        _registry['features'] = _build_feature_registry()
+        _registry['key'] = key
+    return _registry['features']
+
+def _build_feature_registry():
+    b = Constants.BEFORE
+    f = Constants.FORKEND
+    a = Constants.AFTER
 
-    if Constants.BINARY:
-        attributes += booleans
+    editing = ['Insert', 'Delete', 'Replace', 'UndoCommand']
+    workspace = 'org.eclipse.jdt.ui.edit.text.java.search.references.in.workspace'
+    project = 'org.eclipse.jdt.ui.edit.text.java.search.references.in.project'
+
+    registry = OrderedDict()
+    def declare(name, terms, type='NUMERIC'):
+        registry[name] = Feature(name, type, terms)
+
+    declare('opens_before', [('command', 'FileOpenCommand', -60, 0)])
+    declare('opens_after', [('command', 'FileOpenCommand', 0, 60)])
+    declare('selects_before', [('command', 'SelectTextCommand', -60, 0)])
+    declare('selects_after', [('command', 'SelectTextCommand', 0, 60)])
+    declare('edits_before', [('command', i, b, f) for i in editing])
+    declare('edits_after', [('command', i, f, a) for i in editing])
+    declare('searching_before', [('eclipsecommand', group_members('search'), b, f)])
+    declare('searching_after', [('eclipsecommand', group_members('search'), f, a)])
+    declare('references_before', [('eclipsecommand', workspace, -60, 0), ('eclipsecommand', project, -60, 0)])
+    declare('references_after', [('eclipsecommand', workspace, 0, 60), ('eclipsecommand', project, -60, 0)])
+    declare('debugging_before', [('eclipsecommand', group_members('debugging_eclipsecommands'), b, f)])
+    declare('debugging_after', [('eclipsecommand', group_members('debugging_eclipsecommands'), f, a)])
+    declare('runs_before', [('command', 'RunCommand', -60, 0)])
+    declare('runs_after', [('command', 'RunCommand', 0, 60)])
+    declare('exists_search_before_open', [('pattern', 'search_before_open', b, f)])
+    declare('exists_search_before_select', [('pattern', 'search_before_select', f, a)])
+
+    for name, members in groups().iteritems():
+        if not hasattr(Groups, name):
+            declare(name + '_before', [('eclipsecommand', members, b, f)])
+            declare(name + '_after', [('eclipsecommand', members, f, a)])
+    return registry
+
+_selection = {}
+
+def selected_features():
+    """The features of the registry that Constants.FEATURES selects, in the order of the registry."""
+    registry = feature_registry()
+    key = (_registry['key'], tuple(Constants.FEATURES) if Constants.FEATURES is not None else None)
+    if _selection.get('key') == key:
+        return _selection['features']
+
+    if Constants.FEATURES is None:
+        features = registry.values()
+    else:
+        unknown = [name for name in Constants.FEATURES if name not in registry]
+        if unknown:
+            raise ValueError("Unknown features: %s" % ", ".join(unknown))
+        features = [feature for name, feature in registry.iteritems() if name in Constants.FEATURES]
+
+    _selection['features'] = features
+    _selection['key'] = key
+    return features
+
+def feature_functions():
+    """The function that counts each feature of count_features, by the feature's name in relations()."""
+    return OrderedDict((feature.name, feature.count) for feature in selected_features())
+
+def count_features(c, fork_row):
+    """The counts behind each feature, before they are put into categories or booleans."""
+    return [profile_call(name, function, c, fork_row) for name, function in feature_functions().iteritems()]
+
+def encode_features(attributes):
+    """Adds the categorical and boolean versions of the counts, as set in the Constants."""
+    return encode_matrix([attributes])[0]
+
+def _engine_count_features(c, fork_row):
+    """count_features with the engine of the Constants. A run that only needs to know whether the features
+    happened uses exists_features instead."""
+    if existence_only():
+        return exists_features(c, fork_row)
+    if Constants.ENGINE == 'plan':
+        return profile_call('planned_count_features', planned_count_features, c, fork_row)
+    return count_features(c, fork_row)
+
+def gather_counts(c, fork_row):
+    """The counts of count_features, from the feature cache when it has them."""
+    if _feature_cache is None:
+        return _engine_count_features(c, fork_row)
+
+    counts = _feature_cache.get(fork_row)
+    if counts is None:
+        counts = _engine_count_features(c, fork_row)
+        _feature_cache.put(fork_row, counts)
+    return counts
 
-    return attributes
+def gather_features(c, fork_row):
+    """A list of the features"""
+    return encode_features(gather_counts(c, fork_row))
+
+def feature_terms():
+    """The window counts that make up each feature of count_features, in the same order. Each term is a
+    (kind, event, start, after) tuple, where kind is 'command' or 'eclipsecommand' for a window count and
+    'pattern' for the name of a sequence pattern. The event of a window count can be a tuple of events, like the
+    members of a group, which are counted together. A feature is the sum of its terms."""
+    return OrderedDict((feature.name, feature.terms) for feature in selected_features())
+
+def plan_queries(terms):
+    """Collects the distinct window counts of feature_terms. Returns the (kind, event) selectors of every distinct
+    (start, after) window, and the distinct (name, start, after) sequence patterns."""
+    windows = OrderedDict()
+    patterns = OrderedDict()
+    for feature in terms.itervalues():
+        for kind, event, start, after in feature:
+            if kind == 'pattern':
+                patterns[(event, start, after)] = True
+            else:
+                windows.setdefault((start, after), OrderedDict())[(kind, event)] = True
+    return windows, patterns
+
+def _selector_filter(table, selectors):
+    """A condition that matches the commands of any of the (column, event) selectors, and its parameters."""
+    conditions = []
+    params = []
+    for column in ('command', 'eclipsecommand'):
+        events = list(OrderedDict.fromkeys(member for kind, event in selectors if kind == column
+            for member in (event if isinstance(event, tuple) else (event,))))
+        if events:
+            conditions.append(table + "." + column + " IN (" + ", ".join("?" * len(events)) + ")")
+            params += events
+    return "(" + " OR ".join(conditions) + ")", params
+
+def _selected(grouped, column, event):
+    """The total of the (command, eclipsecommand) groups of a grouped count that match a selector."""
+    position = 0 if column == 'command' else 1
+    events = event if isinstance(event, tuple) else (event,)
+    return sum(n for group, n in grouped.iteritems() if group[position] in events)
+
+def _trigger_epoch(c, fork_row):
+    """The epoch seconds of a trigger row, or None if it is not in the codes table."""
+    result = c.execute("SELECT " + _epoch_sql(c, 'codes') + " FROM codes WHERE participant = ? AND videotime = ? \
+        LIMIT 1", (fork_row['participant'], fork_row['videotime'])).fetchone()
+    return result[0] if result is not None else None
+
+def _grouped_window_counts(c, participant, selectors, low, high):
+    """Counts the participant's commands of the selectors between two epochs, grouped by (command,
+    eclipsecommand)."""
+    condition, params = _selector_filter('commands', selectors)
+    q = "SELECT command, eclipsecommand, COUNT(*) FROM commands WHERE participant = ? AND " + condition + " \
+        AND " + _epoch_sql(c, 'commands') + " BETWEEN ? AND ? GROUP BY command, eclipsecommand"
+    return dict(((command, eclipsecommand), n)
+        for command, eclipsecommand, n in c.execute(q, [participant] + params + [low, high]))
+
+def _grouped_pattern_count(c, participant, pattern, epoch, start, after):
+    """num_pattern_at_fork with one query that joins the anchors to their followers."""
+    condition, params = _selector_filter('a', [(column, event) for column, event in pattern.anchors])
+    follower_column, follower = pattern.follower
+    q = "SELECT a.command, a.eclipsecommand, COUNT(*) FROM commands AS a JOIN commands AS f \
+        ON f.participant = a.participant AND f." + follower_column + " = ? \
+            AND " + _epoch_sql(c, 'f') + " > " + _epoch_sql(c, 'a') + " AND " + _epoch_sql(c, 'f') + " < ? \
+        WHERE a.participant = ? AND " + condition + " \
+            AND " + _epoch_sql(c, 'a') + " BETWEEN ? AND ? \
+        GROUP BY a.command, a.eclipsecommand"
+    grouped = dict(((command, eclipsecommand), n) for command, eclipsecommand, n in
+        c.execute(q, [follower, epoch + after, participant] + params + [epoch + start, epoch + after]))
+
+    # Every anchor counts once for each time it is listed.
+    return sum(_selected(grouped, column, event) for column, event in pattern.anchors)
+
+def planned_count_features(c, fork_row):
+    """count_features with the overlapping queries merged: one grouped query for each distinct window, and one
+    for each sequence pattern, each shared by all the features that need it."""
+    terms = feature_terms()
+    windows, patterns = plan_queries(terms)
+
+    results = {}
+    epoch = _trigger_epoch(c, fork_row)
+    if epoch is not None:
+        for (start, after), selectors in windows.iteritems():
+            grouped = _grouped_window_counts(c, fork_row['participant'], selectors, epoch + start, epoch + after)
+            for kind, event in selectors:
+                results[(kind, event, start, after)] = _selected(grouped, kind, event)
+
+        for name, start, after in patterns:
+            results[('pattern', name, start, after)] = _grouped_pattern_count(c, fork_row['participant'],
+                sequence_patterns()[name], epoch, start, after)
+
+    return [sum(results.get(term, 0) for term in feature) for feature in terms.itervalues()]
+
+def _set_term_sql(c, kind, event, start, after):
+    """The SUM(CASE ...) pivot of one term of feature_terms, and its parameters."""
+    if kind in ('command', 'eclipsecommand'):
+        condition, events = _event_condition("c." + kind, event)
+        return "SUM(CASE WHEN " + condition + " AND c.epoch - t.epoch BETWEEN ? AND ? THEN 1 ELSE 0 END)", \
+            events + [start, after]
+    elif kind == 'pattern':
+        # One pivot per anchor, so an anchor listed twice is counted twice like in num_pattern_at_fork.
+        pattern = sequence_patterns()[event]
+        follower_column, follower = pattern.follower
+        sums = []
+        params = []
+        for column, anchor in pattern.anchors:
+            sums.append("SUM(CASE WHEN c." + column + " = ? AND c.epoch - t.epoch BETWEEN ? AND ? THEN \
+                (SELECT COUNT(*) FROM commands AS f WHERE f.participant = t.participant \
+                    AND f." + follower_column + " = ? \
+                    AND " + _epoch_sql(c, 'f') + " - c.epoch > 0 \
+                    AND " + _epoch_sql(c, 'f') + " - t.epoch < ?) \
+                ELSE 0 END)")
+            params += [anchor, start, after, follower, after]
+        return " + ".join(sums), params
+    else:
+        raise ValueError("Unknown feature term: %s" % kind)
+
+def set_count_features(c, rows):
+    """Computes count_features for every trigger row with one query. The rows are put into a temporary table
+    that is joined to the commands in the widest window of any feature, and each feature is a SUM(CASE ...)
+    pivot over the joined commands. Returns the counts in the order of the rows."""
+    terms = feature_terms()
+    windows = [(start, after) for feature in terms.itervalues() for (kind, event, start, after) in feature]
+    lowest = min(start for start, after in windows)
+    highest = max(after for start, after in windows)
+
+    c.execute("DROP TABLE IF EXISTS temp.triggers")
+    c.execute("CREATE TEMP TABLE triggers (id INTEGER PRIMARY KEY, participant, videotime, epoch INTEGER)")
+    c.executemany("INSERT INTO temp.triggers (id, participant, videotime, epoch) \
+        SELECT ?, participant, videotime, " + _epoch_sql(c, 'codes') + " FROM codes \
+        WHERE participant = ? AND videotime = ? LIMIT 1",
+        [(i, row['participant'], row['videotime']) for i, row in enumerate(rows)])
+
+    columns = []
+    params = []
+    for feature in terms.itervalues():
+        sums = []
+        for term in feature:
+            sql, term_params = _set_term_sql(c, *term)
+            sums.append(sql)
+            params += term_params
+        columns.append(" + ".join(sums))
+
+    if epoch_columns_ready(c):
+        commands = "commands"
+    else:
+        commands = "(SELECT participant, videotime, command, eclipsecommand, \
+            CAST(strftime('%s', videotime) AS INTEGER) AS epoch FROM commands)"
+
+    q = "SELECT t.id, " + ", ".join(columns) + " FROM temp.triggers AS t LEFT JOIN " + commands + " AS c \
+        ON c.participant = t.participant AND c.epoch BETWEEN t.epoch + ? AND t.epoch + ? \
+        GROUP BY t.id"
+
+    counts = [[0] * len(terms) for row in rows]
+    for result in c.execute(q, params + [lowest, highest]):
+        result = list(result)
+        counts[result[0]] = result[1:]
+
+    c.execute("DROP TABLE temp.triggers")
+    return counts
+
+def _count_rows(c, rows, count_rows):
+    """The counts of count_rows for the trigger rows. A run that only needs existence_only() gets 1 or 0 like
+    exists_features, so that every engine gives (and caches) the same values."""
+    counts = profile_call(count_rows.__name__, count_rows, c, rows)
+    if existence_only():
+        return [[int(count > 0) for count in row_counts] for row_counts in counts]
+    return counts
+
+def _gather_features_rows(c, rows, count_rows):
+    """gather_features for every trigger row at once, counting the rows the feature cache does not have with a
+    function that counts many rows together."""
+    if _feature_cache is None:
+        return encode_matrix(_count_rows(c, rows, count_rows))
+
+    counts = [_feature_cache.get(row) for row in rows]
+    missing = [i for i in range(len(rows)) if counts[i] is None]
+    computed = _count_rows(c, [rows[i] for i in missing], count_rows)
+    for i, row_counts in izip(missing, computed):
+        _feature_cache.put(rows[i], row_counts)
+        counts[i] = row_counts
+    return encode_matrix(counts)
+
+def gather_features_set(c, rows):
+    """gather_features for every trigger row at once, using set_count_features."""
+    return _gather_features_rows(c, rows, set_count_features)
+
+def _stream_lookups(terms):
+    """The distinct terms of feature_terms by their position, and for the (column, event) of a command the
+    positions of the window terms it counts for, of the sequence patterns it is an anchor of (once for each time
+    it is listed) and of the sequence patterns it is the follower of."""
+    positions = OrderedDict()
+    for feature in terms.itervalues():
+        for term in feature:
+            positions.setdefault(term, len(positions))
+
+    windows = {}
+    anchors = {}
+    followers = {}
+    for (kind, event, start, after), position in positions.iteritems():
+        if kind == 'pattern':
+            pattern = sequence_patterns()[event]
+            for anchor in pattern.anchors:
+                anchors.setdefault(anchor, []).append((position, start, after))
+            followers.setdefault(pattern.follower, []).append((position, after))
+        else:
+            for member in (event if isinstance(event, tuple) else (event,)):
+                windows.setdefault((kind, member), []).append((position, start, after))
+    return positions, windows, anchors, followers
+
+def _fetch_stream(c, q, params, size):
+    """The rows of a query, fetched 'size' rows at a time."""
+    c.execute(q, params)
+    while True:
+        chunk = c.fetchmany(size)
+        if not chunk:
+            return
+        for row in chunk:
+            yield row
+
+def stream_count_features(c, rows):
+    """Computes count_features for every trigger row in one pass over the codes and commands tables, read in
+    one stream ordered by participant and time. Every trigger comes in the stream where its widest window starts,
+    is counted while the commands of its window go by and is put away when they have passed, so only the
+    triggers whose windows are open are held in memory, never the commands. Returns the counts in the order of
+    the rows.
+
+    A command is only a follower of the anchors at earlier seconds, so all commands of a second are counted as
+    followers before any of them is counted as an anchor."""
+    terms = feature_terms()
+    positions, windows, anchors, followers = _stream_lookups(terms)
+    lowest = min(start for kind, event, start, after in positions)
+    highest = max(after for kind, event, start, after in positions)
+
+    wanted = set((row['participant'], row['videotime']) for row in rows)
+    where, params = _participants_filter(set(row['participant'] for row in rows))
+    q = "SELECT participant, " + _epoch_sql(c, 'codes') + " + ? AS position, 0 AS kind, videotime, \
+            NULL AS command, NULL AS eclipsecommand FROM codes WHERE position IS NOT NULL" + where + " \
+        UNION ALL SELECT participant, " + _epoch_sql(c, 'commands') + ", 1, NULL, command, eclipsecommand \
+            FROM commands WHERE " + _epoch_sql(c, 'commands') + " IS NOT NULL" + where + " \
+        ORDER BY participant, position, kind"
+
+    results = {}
+    started = set()
+    active = deque()
+    commands = []
+
+    def count_commands():
+        epoch = commands[0][0]
+        while active and active[0][0] + highest < epoch:
+            retire()
+        for trigger_epoch, key, counts, anchors_seen in active:
+            offset = epoch - trigger_epoch
+            for command in commands:
+                for selector in command[1]:
+                    for position, start, after in windows.get(selector, ()):
+                        if start <= offset <= after:
+                            counts[position] += 1
+                    for position, after in followers.get(selector, ()):
+                        if offset < after:
+                            counts[position] += anchors_seen[position]
+            for command in commands:
+                for selector in command[1]:
+                    for position, start, after in anchors.get(selector, ()):
+                        if start <= offset <= after:
+                            anchors_seen[position] += 1
+        del commands[:]
+
+    def retire():
+        trigger_epoch, key, counts, anchors_seen = active.popleft()
+        results[key] = counts
+
+    participant = None
+    for row_participant, position, kind, videotime, command, eclipsecommand in \
+            _fetch_stream(c, q, [lowest] + list(params) * 2, Constants.STREAM_ROWS):
+        if commands and (kind == 0 or row_participant != participant or position != commands[0][0]):
+            count_commands()
+        if row_participant != participant:
+            while active:
+                retire()
+            participant = row_participant
+
+        if kind == 0:
+            key = (row_participant, videotime)
+            if key in wanted and key not in started:
+                started.add(key)
+                active.append((position - lowest, key, [0] * len(positions), [0] * len(positions)))
+        else:
+            selectors = []
+            if command is not None:
+                selectors.append(('command', command))
+            if eclipsecommand is not None:
+                selectors.append(('eclipsecommand', eclipsecommand))
+            commands.append((position, selectors))
+
+    if commands:
+        count_commands()
+    while active:
+        retire()
+
+    counts = []
+    for row in rows:
+        term_counts = results.get((row['participant'], row['videotime']))
+        if term_counts is None:
+            counts.append([0] * len(terms))
+        else:
+            counts.append([sum(term_counts[positions[term]] for term in feature) for feature in terms.itervalues()])
+    return counts
+
+def gather_features_stream(c, rows):
+    """gather_features for every trigger row at once, using stream_count_features."""
+    return _gather_features_rows(c, rows, stream_count_features)
+
+def database_fingerprint(path):
+    """A hash of the contents of a database file."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def database_stamp(path):
+    """The path, modification time and size of a database file and of its write-ahead log, which change
+    whenever the database does. Unlike database_fingerprint, it does not read the file."""
+    stamps = [os.path.abspath(path)]
+    for name in [path, path + "-wal"]:
+        if os.path.exists(name):
+            stat = os.stat(name)
+            stamps.append("%r:%d" % (stat.st_mtime, stat.st_size))
+    return " ".join(stamps)
+
+def feature_configuration():
+    """A hash of everything that decides the counts of a trigger row: the feature terms with their windows, the
+    sequence patterns, whether only existence is counted and FEATURES_VERSION."""
+    patterns = [(name, pattern.key()) for name, pattern in sequence_patterns().items()]
+    return hashlib.sha1(repr((FEATURES_VERSION, feature_terms().items(), patterns, existence_only()))).hexdigest()
+
+
+class FeatureCache(object):
+    """The counts of trigger rows, kept in an SQLite file between runs. Every row is keyed by the database
+    fingerprint, the feature configuration and the trigger row, so counts are only used for the same database
+    contents and feature definitions. Counts are stored before encoding, so the categorical, boolean and
+    two-factor attributes are always made from them again. Changes are committed every BLOCK_ROWS rows."""
+
+    def __init__(self, path, database, max_rows=100000):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS counts (database TEXT, configuration TEXT, \
+            participant, videotime, counts TEXT, used INTEGER, \
+            PRIMARY KEY (database, configuration, participant, videotime))")
+        self.database = database
+        self.max_rows = max_rows
+        self.clock = (self.conn.execute("SELECT MAX(used) FROM counts").fetchone()[0] or 0) + 1
+        self.changes = 0
+        self.settings = None
+        self.configuration()
+
+    def configuration(self):
+        """feature_configuration, hashed again only when the windows, groups or selected features change."""
+        settings = (_registry_key(), tuple(Constants.FEATURES) if Constants.FEATURES is not None else None,
+            existence_only())
+        if settings != self.settings:
+            self.settings = settings
+            self._configuration = feature_configuration()
+        return self._configuration
+
+    def key(self, fork_row):
+        return (self.database, self.configuration(), fork_row['participant'], fork_row['videotime'])
+
+    def changed(self):
+        self.changes += 1
+        if self.changes >= Constants.BLOCK_ROWS:
+            self.conn.commit()
+            self.changes = 0
+
+    def get(self, fork_row):
+        """The cached counts of a trigger row, or None."""
+        key = self.key(fork_row)
+        result = self.conn.execute("SELECT counts FROM counts WHERE database = ? AND configuration = ? \
+            AND participant = ? AND videotime = ?", key).fetchone()
+        if result is None:
+            return None
+
+        self.conn.execute("UPDATE counts SET used = ? WHERE database = ? AND configuration = ? \
+            AND participant = ? AND videotime = ?", (self.clock,) + key)
+        self.changed()
+        return json.loads(result[0])
+
+    def put(self, fork_row, counts):
+        self.conn.execute("INSERT OR REPLACE INTO counts VALUES (?, ?, ?, ?, ?, ?)",
+            self.key(fork_row) + (json.dumps(counts), self.clock))
+        self.changed()
+
+    def invalidate(self):
+        """Removes the rows of other database contents or feature configurations."""
+        self.conn.execute("DELETE FROM counts WHERE database <> ? OR configuration <> ?",
+            (self.database, self.configuration()))
+        self.conn.commit()
+
+    def clear(self):
+        """Removes every row."""
+        self.conn.execute("DELETE FROM counts")
+        self.conn.commit()
+
+    def evict(self):
+        """Removes the least recently used rows over max_rows."""
+        self.conn.execute("DELETE FROM counts WHERE rowid IN \
+            (SELECT rowid FROM counts ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_rows,))
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM counts").fetchone()[0]
+
+    def close(self):
+        self.evict()
+        self.conn.close()
+
+
+_feature_cache = None
+
+def use_feature_cache(cache):
+    """Keeps the counts of gather_features in a FeatureCache. Pass None to stop using it."""
+    global _feature_cache
+    _feature_cache = cache
+
+class ProfilingCursor(sqlite3.Cursor):
+    """A cursor that tells the Profiler about its statements and rows. It stands in for
+    Connection.set_trace_callback, which the sqlite3 module of Python 2.7 does not have; the virtual machine steps
+    still come from set_progress_handler (see Profiler.attach)."""
+
+    def execute(self, sql, parameters=()):
+        if _profiler is not None:
+            _profiler.statement(self.connection, sql, parameters)
+        return sqlite3.Cursor.execute(self, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if _profiler is not None:
+            _profiler.statement(self.connection, sql, None)
+        return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+
+    def next(self):
+        row = sqlite3.Cursor.next(self)
+        if _profiler is not None:
+            _profiler.rows(1)
+        return row
+
+    __next__ = next
+
+    def fetchone(self):
+        row = sqlite3.Cursor.fetchone(self)
+        if _profiler is not None and row is not None:
+            _profiler.rows(1)
+        return row
+
+    def fetchmany(self, *size):
+        rows = sqlite3.Cursor.fetchmany(self, *size)
+        if _profiler is not None:
+            _profiler.rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = sqlite3.Cursor.fetchall(self)
+        if _profiler is not None:
+            _profiler.rows(len(rows))
+        return rows
+
+
+class Connection(sqlite3.Connection):
+    """The connections of connect(). Unlike sqlite3.Connection they can be weakly referenced, so what is known
+    about one (see epoch_columns_ready) goes away with it."""
+
+
+class ProfilingConnection(Connection):
+    """A connection whose cursors are ProfilingCursors, so that every statement of the connection is seen without
+    set_trace_callback."""
+
+    def cursor(self, factory=ProfilingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class Profiler(object):
+    """Records the wall time, SQL statements, rows returned and SQLite virtual machine steps of every feature
+    function, and the distinct statements with their query plans. The SQL is only seen on connections made by
+    connect(db, profile=True). A feature that calls another profiled function is counted as a whole."""
+
+    OUTSIDE = '(outside features)'
+
+    def __init__(self, steps=1000):
+        self.steps = steps
+        self.features = OrderedDict()
+        self.statements = OrderedDict()
+        self.current = []
+
+    def attach(self, conn):
+        """Counts the virtual machine steps of a connection, 'steps' at a time."""
+        conn.set_progress_handler(self.progress, self.steps)
+
+    def feature(self):
+        return self.current[0] if self.current else self.OUTSIDE
+
+    def stats(self, name):
+        if name not in self.features:
+            self.features[name] = {'calls': 0, 'seconds': 0.0, 'statements': 0, 'rows': 0, 'vm_steps': 0}
+        return self.features[name]
+
+    def call(self, name, function, *args):
+        if self.current:
+            return function(*args)
+
+        self.current.append(name)
+        started = time.time()
+        try:
+            return function(*args)
+        finally:
+            stats = self.stats(name)
+            stats['calls'] += 1
+            stats['seconds'] += time.time() - started
+            self.current.pop()
+
+    def statement(self, conn, sql, parameters):
+        self.stats(self.feature())['statements'] += 1
+        if sql not in self.statements:
+            self.statements[sql] = {'sql': " ".join(sql.split()), 'count': 0, 'features': [],
+                'plan': self.query_plan(conn, sql, parameters)}
+        statement = self.statements[sql]
+        statement['count'] += 1
+        if self.feature() not in statement['features']:
+            statement['features'].append(self.feature())
+        statement['full_scan'] = any(re.match(r"SCAN (TABLE )?\w+", detail) and "INDEX" not in detail
+            for detail in statement['plan'])
+
+    def rows(self, count):
+        self.stats(self.feature())['rows'] += count
+
+    def progress(self):
+        self.stats(self.feature())['vm_steps'] += self.steps
+        return 0
+
+    def query_plan(self, conn, sql, parameters):
+        """The EXPLAIN QUERY PLAN of a SELECT statement, taken before it first runs so that temporary tables
+        still exist."""
+        if not sql.lstrip().upper().startswith("SELECT") or parameters is None:
+            return []
+        try:
+            return [row[-1] for row in sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+        except sqlite3.Error as e:
+            return ["(no plan: %s)" % e]
+
+    def profile(self):
+        """The whole profile as a dictionary."""
+        return {'features': self.features, 'statements': self.statements.values()}
+
+    def summary(self, profile):
+        """The profile as a table, slowest features first, followed by the statements that scan a whole table
+        (shortened; the JSON profile has them in full)."""
+        lines = ["%-32s %8s %10s %11s %10s %12s" % ('feature', 'calls', 'seconds', 'statements', 'rows', 'vm steps')]
+        for name, stats in sorted(profile['features'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append("%-32s %8d %10.3f %11d %10d %12d" % (name, stats['calls'], stats['seconds'],
+                stats['statements'], stats['rows'], stats['vm_steps']))
+
+        scans = [statement for statement in profile['statements'] if statement['full_scan']]
+        if scans:
+            lines.append("")
+            lines.append("Statements that scan a whole table:")
+            for statement in scans:
+                sql = statement['sql'] if len(statement['sql']) <= 160 else statement['sql'][:157] + "..."
+                lines.append("  %dx in %s: %s" % (statement['count'], ", ".join(statement['features']), sql))
+                for detail in statement['plan']:
+                    lines.append("      " + detail)
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, out=sys.stderr):
+        """Writes the profile to a JSON file and its summary to 'out'."""
+        profile = self.profile()
+        with open(path, 'w') as f:
+            json.dump(profile, f, indent=2)
+        out.write(self.summary(profile))
+
+
+_profiler = None
+
+def use_profiler(profiler):
+    """Records the features in a Profiler. Pass None to stop profiling."""
+    global _profiler
+    _profiler = profiler
+
+def profile_call(name, function, *args):
+    """Calls a feature function, recording it in the Profiler if there is one."""
+    if _profiler is None:
+        return function(*args)
+    return _profiler.call(name, function, *args)
+
+def connect(db, read_only=False, profile=False):
+    """Opens the database so that rows can be read by column name. A read-only connection cannot change the
+    database. The statements of a profiled connection are recorded by the Profiler."""
+    if profile:
+        conn = sqlite3.connect(db, factory=ProfilingConnection)
+    else:
+        conn = sqlite3.connect(db, factory=Connection)
+    conn.row_factory = sqlite3.Row
+    if read_only:
+        conn.execute("PRAGMA query_only = ON")
+    return conn
+
+def settings():
+    """The Constants of this run, to hand to another process."""
+    return dict((k, v) for k, v in vars(Constants).items() if not k.startswith('_'))
+
+def apply_settings(values):
+    """Sets the Constants from a dictionary made by settings()."""
+    for k, v in values.items():
+        setattr(Constants, k, v)
+
+def _local_features(conn, rows):
+    """gather_features for trigger rows in this process, with the engine of the Constants. The rows are counted
+    one at a time and encoded a block of BLOCK_ROWS at a time."""
+    if Constants.ENGINE == 'set':
+        return iter(gather_features_set(conn.cursor(), rows))
+    elif Constants.ENGINE == 'stream':
+        return iter(gather_features_stream(conn.cursor(), rows))
+    else:
+        return (features for block in blocks(rows, Constants.BLOCK_ROWS)
+            for features in encode_matrix([gather_counts(conn.cursor(), row) for row in block]))
+
+_worker_conn = None
+_worker_store = None
+
+def _init_worker(db, values):
+    global _worker_conn, _worker_store
+    apply_settings(values)
+    # The cache connection belongs to the main process, which looks the rows up and keeps the new counts.
+    use_feature_cache(None)
+    # The set engine writes its trigger rows to a temporary table, which a read-only connection cannot do.
+    _worker_conn = connect(db, read_only=Constants.ENGINE != 'set')
+    # The main process has already made the snapshot up to date.
+    _worker_store = EventStore.load(Constants.STORE) if Constants.ENGINE == 'index' and Constants.STORE else None
+
+def _extract_shard(shard):
+    """Extracts the features of one participant's trigger rows in a worker process."""
+    participant, positions, rows = shard
+    if _worker_store is not None:
+        use_event_index(EventIndex.from_store(_worker_store, [participant]))
+    elif Constants.ENGINE == 'index':
+        use_event_index(EventIndex.from_db(_worker_conn.cursor(), [participant]))
+    return positions, list(_local_features(_worker_conn, rows))
+
+def shard_by_participant(rows):
+    """Splits the trigger rows into (participant, positions, rows) shards, largest first. The positions are
+    where the rows are in the given list."""
+    shards = OrderedDict()
+    for position, row in enumerate(rows):
+        positions, shard_rows = shards.setdefault(row['participant'], ([], []))
+        positions.append(position)
+        shard_rows.append(dict(zip(row.keys(), row)))
+    return sorted([(p, positions, shard_rows) for p, (positions, shard_rows) in shards.items()],
+        key=lambda shard: -len(shard[1]))
+
+def iter_features(conn, rows, db=None, workers=1):
+    """Yields gather_features for every trigger row, in the order of the rows. With more than one worker the
+    rows are split by participant over a process pool, where every worker has its own read-only connection to
+    db. The feature cache is used in this process: only the rows it does not have go to the workers, and their
+    counts are put into it as they come back. A row is yielded as soon as it and all rows before it are done."""
+    if workers <= 1:
+        for features in _local_features(conn, rows):
+            yield features
+        return
+
+    done = {}
+    missing = range(len(rows))
+    if _feature_cache is not None:
+        counts = [_feature_cache.get(row) for row in rows]
+        missing = [i for i in missing if counts[i] is None]
+        cached = [i for i in range(len(rows)) if counts[i] is not None]
+        done.update(izip(cached, encode_matrix([counts[i] for i in cached])))
+    if not missing:
+        for position in range(len(rows)):
+            yield done.pop(position)
+        return
+
+    position = 0
+    pool = multiprocessing.Pool(workers, _init_worker, (db, settings()))
+    try:
+        shards = shard_by_participant([rows[i] for i in missing])
+        for positions, shard_features in pool.imap_unordered(_extract_shard, shards):
+            positions = [missing[i] for i in positions]
+            if _feature_cache is not None:
+                for i, features in izip(positions, shard_features):
+                    _feature_cache.put(rows[i], features[:len(relations())])
+            done.update(izip(positions, shard_features))
+            while position in done:
+                yield done.pop(position)
+                position += 1
+    finally:
+        pool.close()
+        pool.join()
+
+def extract_features(conn, rows, db=None, workers=1):
+    """gather_features for every trigger row as a list, see iter_features."""
+    return list(iter_features(conn, rows, db, workers))
 
 def main_effects(attributes):
-    output = ""
-    for attribute in attributes:
-        output += "%2s," % str(attribute)
-    output += " "
-    return output
-
-def two_factor_effects(attributes):
-    output = ""
-    for attribute1 in range(0, len(attributes)):
-        for attribute2 in range(attribute1 + 1, len(attributes)):
-            output += "%2s," % (str(attributes[attribute1] + attributes[attribute2]))
-        output += " "
-    return output
+    return "".join(["%2s," % str(attribute) for attribute in attributes]) + " "
+
+def two_factor_pairs(names):
+    """The two-factor interactions of the numeric attributes with these names, as one group for each first
+    attribute of (first, second, name) triples. The header and the rows both use this order."""
+    return [[(k1, k2, names[k1] + "-plus-" + names[k2]) for k2 in range(k1 + 1, len(names))]
+        for k1 in range(0, len(names))]
+
+def two_factor_block(matrix):
+    """The sums of every two-factor pair for a block of rows of numeric attributes, each row in the order of
+    two_factor_pairs. Uses one NumPy operation for the whole block when NumPy is installed."""
+    if not matrix:
+        return []
+
+    width = len(matrix[0])
+    if numpy is not None:
+        first, second = numpy.triu_indices(width, 1)
+        block = numpy.asarray(matrix, dtype=numpy.int64)
+        return (block[:, first] + block[:, second]).tolist()
+
+    return [[row[k1] + row[k2] for k1 in range(0, width) for k2 in range(k1 + 1, width)] for row in matrix]
+
+def two_factor_effects(attributes, interactions=None):
+    """The two-factor interactions of the numeric attributes of a row. The categorical and boolean attributes
+    are not combined. 'interactions' are the sums when they were already made with two_factor_block."""
+    names = relations().keys()
+    if interactions is None:
+        interactions = two_factor_block([attributes[:len(names)]])[0]
+
+    output = []
+    position = 0
+    for group in two_factor_pairs(names):
+        for value in interactions[position:position + len(group)]:
+            output.append("%2s," % str(value))
+        position += len(group)
+        output.append(" ")
+    return "".join(output)
 
 def constant_variables(fork_row):
     output = ""
@@ -424,17 +2092,68 @@ def response_variable(fork_row, event):
 
     return output
 
-def features_to_datatable(attributes, fork_row, event):
+def features_to_datatable(attributes, fork_row, event, interactions=None, ngram_counts=None):
     output = ""
-    output += main_effects(attributes)
+    if Constants.NUMERIC:
+        output += main_effects(attributes)
+    else:
+        output += main_effects(attributes[len(relations()):])
+
+    if ngram_counts is not None:
+        output += main_effects(ngram_counts)
 
     if Constants.TWO_FACTOR:
-        output += two_factor_effects(attributes)
+        output += two_factor_effects(attributes, interactions)
 
     output += constant_variables(fork_row)
     output += response_variable(fork_row, event)
     return output    
 
+def row_values(attributes, fork_row, event, interactions=None, ngram_counts=None):
+    """The values of a row in the order of the attributes of the header, as features_to_datatable writes them."""
+    values = list(attributes if Constants.NUMERIC else attributes[len(relations()):])
+    if ngram_counts is not None:
+        values += ngram_counts
+
+    if Constants.TWO_FACTOR:
+        if interactions is None:
+            interactions = two_factor_block([attributes[:len(relations())]])[0]
+        values += interactions
+
+    values.append(fork_row['participant'])
+    values.append(response_variable(fork_row, event).strip())
+    return values
+
+def sparse_datatable(values, defaults):
+    """A sparse ARFF row of the values of row_values, leaving out the ones that are the default of their
+    attribute (see attribute_defaults)."""
+    return "{" + ",".join(["%d %s" % (position, value) for position, value in enumerate(values)
+        if str(value) != defaults[position]]) + "}\n"
+
+def header_attributes(arff_header):
+    """The (name, type) of every attribute of an ARFF header, the type being NUMERIC or the list of the nominal
+    values."""
+    attributes = []
+    for line in arff_header.splitlines():
+        attribute = re.match(r"^@ATTRIBUTE (.+?) (NUMERIC|\{(.*)\})$", line)
+        if attribute:
+            values = attribute.group(3)
+            attributes.append((attribute.group(1), attribute.group(2) if values is None
+                else [value.strip() for value in values.split(",")]))
+    return attributes
+
+def attribute_defaults(arff_header):
+    """The value that sparse ARFF leaves out for every attribute of a header: 0 for numeric attributes and the
+    first value of nominal ones."""
+    return ["0" if type == 'NUMERIC' else type[0] for name, type in header_attributes(arff_header)]
+
+def density(values, defaults):
+    """The share of the values of a list of rows (see row_values) that are not the default of their attribute."""
+    total = sum(len(row) for row in values)
+    if not total:
+        return 1.0
+    return sum(str(value) != default for row in values for value, default in izip(row, defaults)) / float(total)
+
 
 def _header_main_effects(relations, event = ""):
     output = ""
@@ -447,24 +2166,41 @@ def _header_categories(relations, event = ""):
     """For each attribute, output the version that is a categorical variable."""
     output = ""
     for k,v in relations.iteritems():
-        output += "@ATTRIBUTE " + 'category__' + k + "__" + event + " " + '{None,Few,Some,Many,Lots}' + "\n"
+        table = BinTable.compile(Constants.CATEGORY_MAPS.get(k, DEFAULT_CATEGORY_MAP))
+        output += "@ATTRIBUTE " + 'category__' + k + "__" + event + " " + '{' + ','.join(table.nominal_values()) \
+            + '}' + "\n"
     output += "\n"
     return output
 
-def _header_binary(relations, event = ""):
-    """For each attribute, output the version that is a categorical variable."""
+def _header_binary(relations, event = "", sparse = False):
+    """For each attribute, output the version that is a categorical variable. Sparse files put False first, so
+    that it is the value left out."""
     output = ""
+    values = '{False,True,None}' if sparse else '{True,False,None}'
     for k,v in relations.iteritems():
-        output += "@ATTRIBUTE " + 'binary__' + k + "__" + event + " " + '{True,False,None}' + "\n"
+        output += "@ATTRIBUTE " + 'binary__' + k + "__" + event + " " + values + "\n"
     output += "\n"
     return output
 
-def _header_two_factor_effects(relations):
+def _header_ngrams(grams, event = ""):
+    """For each chosen n-gram, its counts before and after the fork."""
     output = ""
-    keys = relations.keys()
-    for k1 in range(0, len(keys)):
-        for k2 in range(k1 + 1, len(keys)):
-            output += "@ATTRIBUTE " + keys[k1] + "-plus-" + keys[k2] + "__" + event + " " + relations[keys[k2]] + "\n"
+    for name in ngram_names(grams):
+        output += "@ATTRIBUTE " + _arff_name(name + "__" + event) + " NUMERIC\n"
+    output += "\n"
+    return output
+
+def _arff_name(name):
+    """An attribute name, quoted when it has characters that ARFF does not allow in a bare name."""
+    if re.match(r"^[A-Za-z][\w.-]*$", name):
+        return name
+    return "'" + name.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def _header_two_factor_effects(relations, event = ""):
+    output = ""
+    for group in two_factor_pairs(relations.keys()):
+        for k1, k2, name in group:
+            output += "@ATTRIBUTE " + name + "__" + event + " NUMERIC\n"
         output += "\n"
     return output
 
@@ -483,46 +2219,44 @@ def _header_response_variable(event):
     elif event == 'ForagingEnd':
         return "@ATTRIBUTE foraging_end {ForagingEnd, NotForagingEnd}"
 
-def _header_constant_variables():
-    return "@ATTRIBUTE participant {2,3,4,5,6,7,8,9,10,11,12}\n"
+def _header_constant_variables(participants=None):
+    """The participant attribute, with the participants of the IFT Forks study unless others are given."""
+    if participants is None:
+        participants = range(2, 13)
+    return "@ATTRIBUTE participant {" + ",".join(str(participant) for participant in participants) + "}\n"
+
+def participant_values(rows):
+    """The participants of the trigger rows in order, numbers within a name in numeric order (p2 before p10)."""
+    return sorted(set(row['participant'] for row in rows), key=lambda participant: [int(part) if part.isdigit()
+        else part for part in re.split(r"(\d+)", str(participant))])
 
-def header(event):
-    """Outputs the ARFF header. If you change the features in gather_features, you have to change the
-    header as well and add the relations."""
+def relations():
+    """The names and types of the features of count_features."""
+    return OrderedDict((feature.name, feature.type) for feature in selected_features())
+
+def header(event, ngrams=None, sparse=False, participants=None):
+    """Outputs the ARFF header, with the attributes of an NgramTable when there is one, for a dense or a sparse
+    file. 'participants' are the values of the participant attribute (see _header_constant_variables)."""
     output = "@RELATION " + Constants.NAME + "\n\n"
 
-    relations = OrderedDict()
-    # relations['participant'] = 'STRING'
-    # relations['videotime'] = 'STRING'
-    relations['opens_before'] = 'NUMERIC'
-    relations['opens_after'] = 'NUMERIC'
-    relations['selects_before'] = 'NUMERIC'
-    relations['selects_after'] = 'NUMERIC'
-    relations['edits_before'] = 'NUMERIC'
-    relations['edits_after'] = 'NUMERIC'
-    relations['searching_before'] = 'NUMERIC'
-    relations['searching_after'] = 'NUMERIC'
-    relations['references_before'] = 'NUMERIC'
-    relations['references_after'] = 'NUMERIC'
-    relations['debugging_before'] = 'NUMERIC'
-    relations['debugging_after'] = 'NUMERIC'
-    relations['runs_before'] = 'NUMERIC'
-    relations['runs_after'] = 'NUMERIC'
-    relations['exists_search_before_open'] = 'NUMERIC'
-    relations['exists_search_before_select'] = 'NUMERIC'
-
-    output += _header_main_effects(relations, event)
+    features = relations()
+
+    if Constants.NUMERIC:
+        output += _header_main_effects(features, event)
 
     if Constants.CATEGORY:
-        output += _header_categories(relations, event)
+        output += _header_categories(features, event)
 
     if Constants.BINARY:
-        output += _header_binary(relations, event)
+        output += _header_binary(features, event, sparse)
+
+    if ngrams is not None:
+        output += _header_ngrams(ngrams.grams, event)
 
     if Constants.TWO_FACTOR:
-        output += _header_two_factor_effects(relations, event) 
+        output += _header_two_factor_effects(features, event) 
 
-    output += _header_constant_variables()
+    output += _header_constant_variables(participants)
     output += _header_response_variable(event)
 
     output += "\n\n@DATA\n"
@@ -530,30 +2264,750 @@ def header(event):
     return output
 
 
+def blocks(items, size):
+    """Groups the items into lists of 'size' items."""
+    block = []
+    for item in items:
+        block.append(item)
+        if len(block) == size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+def arff_chunks(event, rows, all_features, ngrams=None, sparse=None, participants=None):
+    """The ARFF file as a stream of strings: the header, then one line for each trigger row and its features,
+    and its n-gram counts when there is an NgramTable of the rows. With two-factor interactions, the rows are
+    handled in blocks so their interactions are computed together. The file is sparse or dense as 'sparse' says,
+    or as Constants.SPARSE says when it is None; when both are None, the first SPARSE_SAMPLE rows are extracted
+    before the header to measure their density. The participant attribute has 'participants', or the
+    participants of the rows when it is None."""
+    if participants is None:
+        participants = participant_values(rows)
+    items = izip(rows, all_features, ngrams.counts if ngrams is not None else repeat(None))
+    if sparse is None:
+        sparse = Constants.SPARSE
+    if sparse is None:
+        sample = list(islice(items, Constants.SPARSE_SAMPLE))
+        defaults = attribute_defaults(header(event, ngrams, True, participants))
+        values = [row_values(features, row, event, ngram_counts=row_ngrams) for row, features, row_ngrams in sample]
+        sparse = density(values, defaults) < Constants.SPARSE_DENSITY
+        items = chain(sample, items)
+
+    arff_header = header(event, ngrams, sparse, participants)
+    yield arff_header
+    defaults = attribute_defaults(arff_header)
+
+    def datatable(row, features, row_ngrams, interactions=None):
+        if sparse:
+            return sparse_datatable(row_values(features, row, event, interactions, row_ngrams), defaults)
+        return features_to_datatable(features, row, event, interactions, row_ngrams)
+
+    if not Constants.TWO_FACTOR:
+        for row, features, row_ngrams in items:
+            yield datatable(row, features, row_ngrams)
+        return
+
+    width = len(relations())
+    for block in blocks(items, Constants.BLOCK_ROWS):
+        interactions = two_factor_block([features[:width] for row, features, row_ngrams in block])
+        for (row, features, row_ngrams), row_interactions in izip(block, interactions):
+            yield datatable(row, features, row_ngrams, row_interactions)
+
+def report_progress(items, total, out=sys.stderr, every=1.0):
+    """Passes the items through, writing how many are done to 'out' at most every 'every' seconds."""
+    last = time.time()
+    done = 0
+    for item in items:
+        yield item
+        done += 1
+        if time.time() - last >= every or done == total:
+            last = time.time()
+            out.write("\r%d/%d rows" % (done, total))
+            out.flush()
+    out.write("\n")
+
+def open_arff(path, compress=False):
+    """Opens an ARFF file for buffered writing, gzipped if compress is set."""
+    if compress:
+        return gzip.open(path, 'wb')
+    else:
+        return open(path, 'w', 1 << 16)
+
+def write_arff(path, chunks, compress=False):
+    """Writes the chunks to the file as they come, so the whole file never has to be in memory."""
+    with open_arff(path, compress) as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def write_npy(path, data, shape):
+    """Writes an array of the array module as a .npy file (format 1.0) of the given shape, so that NumPy can load
+    or map it whether or not it is installed here."""
+    descr = {'i': ('<' if sys.byteorder == 'little' else '>') + 'i4', 'b': '|i1'}[data.typecode]
+    description = "{'descr': '%s', 'fortran_order': False, 'shape': %r, }" % (descr, tuple(shape))
+    description += " " * (-(10 + len(description) + 1) % 64) + "\n"
+    with open(path, 'wb') as f:
+        f.write(b"\x93NUMPY\x01\x00" + struct.pack('<H', len(description)) + description)
+        f.write(data.tostring())
+
+def read_npy(path):
+    """Reads a .npy file written by write_npy as an array of the array module and its shape."""
+    with open(path, 'rb') as f:
+        f.read(8)
+        size, = struct.unpack('<H', f.read(2))
+        description = ast.literal_eval(f.read(size))
+        data = array('i' if description['descr'][1:] == 'i4' else 'b', f.read())
+    if description['descr'][0] not in "|=" and (description['descr'][0] == '<') != (sys.byteorder == 'little'):
+        data.byteswap()
+    return data, description['shape']
+
+
+class FeatureColumns(object):
+    """The feature matrix of a run, kept as columns while the ARFF file is written from the same rows (see
+    collect). save() writes a directory of .npy files, which numpy.load(path, mmap_mode='r') maps without copying
+    them: 'counts' (rows x features), 'categories' with the position of each label in its feature's category
+    labels, 'booleans' as 0 or 1, 'ngrams' when there are n-grams, 'participants' and 'labels' with the position
+    of the participant and of the response value. A run that only needs existence_only() has no counts, only
+    the booleans. metadata.json has the names of the columns of each file, the category labels, the
+    participants, the response values and the attributes of the ARFF header."""
+
+    def __init__(self):
+        self.width = len(relations())
+        self.tables = category_tables()
+        self.codes = [dict((label, code) for code, label in enumerate(table.nominal_values())) for table in self.tables]
+        self.counts = array('i')
+        self.categories = array('b')
+        self.booleans = array('b')
+        self.rows = 0
+
+    def add(self, features):
+        """Adds the features of gather_features of a row."""
+        width = self.width
+        self.counts.extend(features[:width])
+        position = width
+        if Constants.CATEGORY:
+            labels = features[position:position + width]
+            self.categories.extend(codes[label] for codes, label in izip(self.codes, labels))
+            position += width
+        if Constants.BINARY:
+            self.booleans.extend(int(boolean) for boolean in features[position:position + width])
+        self.rows += 1
+
+    def collect(self, all_features):
+        """Passes the features of the rows through, adding each."""
+        for features in all_features:
+            self.add(features)
+            yield features
+
+    def save(self, directory, event, rows, ngrams=None, participants=None):
+        """Writes the columns of the collected trigger rows to the directory. 'participants' are the values of the
+        participant attribute, those of the rows when it is None."""
+        if len(rows) != self.rows:
+            raise ValueError("%d rows were collected for %d trigger rows" % (self.rows, len(rows)))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        names = relations().keys()
+        if participants is None:
+            participants = participant_values(rows)
+        responses = dict(header_attributes(_header_response_variable(event))).values()[0]
+        files = [('counts', self.counts, names)] if not existence_only() else []
+        if Constants.CATEGORY:
+            files.append(('categories', self.categories, ['category__' + name for name in names]))
+        if Constants.BINARY:
+            files.append(('booleans', self.booleans, ['binary__' + name for name in names]))
+        if ngrams is not None:
+            files.append(('ngrams', array('i', chain.from_iterable(ngrams.counts)), ngram_names(ngrams.grams)))
+
+        metadata = {'relation': Constants.NAME, 'event': event, 'rows': self.rows, 'files': {},
+            'category_labels': [table.nominal_values() for table in self.tables], 'labels': responses,
+            'participants': participants, 'attributes': header_attributes(header(event, ngrams,
+                participants=participants))}
+        for name, data, columns in files:
+            write_npy(os.path.join(directory, name + ".npy"), data, (self.rows, len(columns)))
+            metadata['files'][name] = columns
+
+        positions = dict((participant, position) for position, participant in enumerate(participants))
+        write_npy(os.path.join(directory, "participants.npy"), array('i', [positions[row['participant']]
+            for row in rows]), (self.rows,))
+        write_npy(os.path.join(directory, "labels.npy"), array('b', [responses.index(response_variable(row,
+            event).strip()) for row in rows]), (self.rows,))
+        with open(os.path.join(directory, "metadata.json"), 'w') as f:
+            json.dump(metadata, f, indent=1)
+
+def load_columns(directory):
+    """The metadata of a directory written by FeatureColumns.save and its files by name: mapped NumPy arrays, or
+    (array, shape) pairs of read_npy without NumPy."""
+    with open(os.path.join(directory, "metadata.json")) as f:
+        metadata = json.load(f)
+
+    columns = {}
+    for name in metadata['files'].keys() + ['participants', 'labels']:
+        path = os.path.join(directory, name + ".npy")
+        columns[name] = numpy.load(path, mmap_mode='r') if numpy is not None else read_npy(path)
+    return metadata, columns
+
+
+def sweep_grid(grid):
+    """Every combination of the values of a grid of Constants, as a list of dictionaries."""
+    names = sorted(grid.keys())
+    return [dict(zip(names, values)) for values in product(*[grid[name] for name in names])]
+
+def split_outfile(outfile):
+    """Splits an output file name into its base and its extension, where a compressed file keeps both of its
+    extensions (out.arff.gz is out and .arff.gz)."""
+    base, extension = os.path.splitext(outfile)
+    if extension == ".gz":
+        base, arff = os.path.splitext(base)
+        extension = arff + extension
+    return base, extension
+
+def sweep_outfile(outfile, configuration):
+    """The file name of one configuration of a sweep."""
+    base, extension = split_outfile(outfile)
+    suffix = "_".join("%s%s" % (name.lower(), configuration[name]) for name in sorted(configuration))
+    return base + "_" + suffix + extension
+
+def sweep(conn, rows, event, configurations, outfile):
+    """Writes one ARFF file for each configuration of Constants, all answered from one PrefixIndex. With
+    Constants.COLUMNS, each configuration's columns go to a directory named like its ARFF file. Returns the names
+    of the files."""
+    use_event_index(PrefixIndex.from_db(conn.cursor()))
+
+    original = settings()
+    outfiles = []
+    try:
+        for configuration in configurations:
+            apply_settings(configuration)
+            Constants.ENGINE = 'index'
+
+            path = sweep_outfile(outfile, configuration)
+            all_features = iter_features(conn, rows)
+            columns = FeatureColumns() if Constants.COLUMNS else None
+            if columns is not None:
+                all_features = columns.collect(all_features)
+
+            ngrams = ngram_table(conn.cursor(), rows)
+            write_arff(path, arff_chunks(event, rows, all_features, ngrams), Constants.GZIP)
+            if columns is not None:
+                columns.save(sweep_outfile(Constants.COLUMNS, configuration), event, rows, ngrams)
+            outfiles.append(path)
+    finally:
+        apply_settings(original)
+        use_event_index(None)
+    return outfiles
+
+
+def row_fingerprint(row):
+    """A hash of the columns of a trigger row."""
+    return hashlib.sha1(repr([(k, row[k]) for k in sorted(row.keys())])).hexdigest()
+
+def commands_fingerprint(c):
+    """A hash of the contents of the commands table."""
+    digest = hashlib.sha1()
+    for row in c.execute("SELECT participant, videotime, command, eclipsecommand FROM commands ORDER BY rowid"):
+        digest.update(repr(tuple(row)))
+    return digest.hexdigest()
+
+def manifest_path(path):
+    """The file next to an ARFF file that records what went into it."""
+    return path + ".manifest"
+
+def _open_existing_arff(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    else:
+        return open(path)
+
+def _reusable_lines(path, arff_header, state):
+    """The data lines of an earlier ARFF file by the fingerprint of their trigger row, or nothing if the file
+    was made with another header, other features or other commands."""
+    if not (os.path.exists(path) and os.path.exists(manifest_path(path))):
+        return {}
+
+    with open(manifest_path(path)) as f:
+        manifest = json.load(f)
+    if manifest['state'] != state:
+        return {}
+
+    with _open_existing_arff(path) as f:
+        content = f.read()
+    if not content.startswith(arff_header):
+        return {}
+
+    lines = content[len(arff_header):].splitlines(True)
+    if len(lines) != len(manifest['rows']):
+        return {}
+
+    reusable = {}
+    for fingerprint, line in izip(manifest['rows'], lines):
+        reusable.setdefault(fingerprint, []).append(line)
+    return reusable
+
+def update_arff(conn, rows, event, path, db=None, workers=1):
+    """Writes the ARFF file for the trigger rows at path, reusing the lines of the file that is already there for
+    the rows that did not change, and records the rows in the manifest next to it. A path ending in .gz is read
+    and written compressed. Returns the number of rows whose features were extracted. Constants.COLUMNS cannot be
+    used, as only the changed rows are extracted."""
+    if Constants.COLUMNS:
+        raise ValueError("COLUMNS cannot be written with INCREMENTAL, which only extracts the changed trigger rows")
+    state = {'event': event, 'features': feature_configuration(), 'encoding': encoding_configuration(),
+        'commands': commands_fingerprint(conn.cursor())}
+    ngrams = ngram_table(conn.cursor(), rows)
+    participants = participant_values(rows)
+    sparse = Constants.SPARSE
+    reusable = {}
+    for candidate in ([sparse] if sparse is not None else [False, True]):
+        reusable = _reusable_lines(path, header(event, ngrams, candidate, participants), state)
+        if reusable:
+            sparse = candidate
+            break
+
+    fingerprints = [row_fingerprint(row) for row in rows]
+    lines = []
+    missing = []
+    for position, fingerprint in enumerate(fingerprints):
+        if reusable.get(fingerprint):
+            lines.append(reusable[fingerprint].pop(0))
+        else:
+            lines.append(None)
+            missing.append(position)
+
+    extracted = arff_chunks(event, [rows[position] for position in missing],
+        iter_features(conn, [rows[position] for position in missing], db, workers),
+        ngrams.select(missing) if ngrams is not None else None, sparse, participants)
+    arff_header = next(extracted)
+
+    def chunks():
+        yield arff_header
+        for line in lines:
+            yield line if line is not None else next(extracted)
+
+    write_arff(path + ".tmp", chunks(), path.endswith(".gz"))
+    os.rename(path + ".tmp", path)
+    with open(manifest_path(path), 'w') as f:
+        json.dump({'state': state, 'rows': fingerprints}, f)
+
+    return len(missing)
+
+
+def event_outfile(outfile, event):
+    """The file name of one event's ARFF file when all events are written."""
+    base, extension = split_outfile(outfile)
+    return base + "-" + event + extension
+
+def write_all_events(conn, events, outfile, db=None, workers=1, compress=False):
+    """Writes one ARFF file for each event, with its own trigger rows and response variable. The features of a
+    (participant, videotime) are extracted once, even when it is a trigger row of several events. With
+    Constants.COLUMNS, each event's columns go to a directory named like its ARFF file. Returns the names of the
+    files."""
+    c = conn.cursor()
+    event_rows = OrderedDict((event, list(trigger_rows(c, event))) for event in events)
+
+    distinct = OrderedDict()
+    for rows in event_rows.itervalues():
+        for row in rows:
+            distinct.setdefault((row['participant'], row['videotime']), row)
+    features = dict(izip(distinct.keys(), iter_features(conn, distinct.values(), db, workers)))
+
+    outfiles = []
+    for event, rows in event_rows.iteritems():
+        path = event_outfile(outfile, event)
+        all_features = (features[(row['participant'], row['videotime'])] for row in rows)
+        columns = FeatureColumns() if Constants.COLUMNS else None
+        if columns is not None:
+            all_features = columns.collect(all_features)
+
+        ngrams = ngram_table(c, rows)
+        write_arff(path, arff_chunks(event, rows, all_features, ngrams), compress)
+        if columns is not None:
+            columns.save(event_outfile(Constants.COLUMNS, event), event, rows, ngrams)
+        outfiles.append(path)
+    return outfiles
+
+
+def study_participant(study, participant):
+    """The name of a participant of a study in a batch of study databases, which no other study has."""
+    return "%s_%s" % (re.sub(r"[^\w.-]", "_", study), participant)
+
+def extract_study(study, db, events):
+    """The trigger rows of each event in a study database, as dictionaries with the study and a
+    study_participant, their features and, when Constants.NGRAMS is set, their n-gram counts (see ngram_counts),
+    as an (event, (rows, features, counts)) list. The features of a (participant, videotime) are extracted once,
+    even when it is a trigger row of several events."""
+    # The set engine writes its trigger rows to a temporary table, which a read-only connection cannot do.
+    conn = connect(db, read_only=Constants.ENGINE != 'set')
+    try:
+        c = conn.cursor()
+        event_rows = [(event, list(trigger_rows(c, event))) for event in events]
+        distinct = OrderedDict()
+        for event, rows in event_rows:
+            for row in rows:
+                distinct.setdefault((row['participant'], row['videotime']), row)
+
+        if Constants.ENGINE == 'index':
+            use_event_index(EventIndex.from_db(c))
+        try:
+            features = dict(izip(distinct.keys(), extract_features(conn, distinct.values())))
+        finally:
+            use_event_index(None)
+        counts = dict(izip(distinct.keys(), ngram_counts(c, distinct.values(), ngram_windows(),
+            Constants.NGRAM_SIZES))) if Constants.NGRAMS else None
+    finally:
+        conn.close()
+
+    results = []
+    for event, rows in event_rows:
+        study_rows = []
+        for row in rows:
+            study_row = dict(izip(row.keys(), row))
+            study_row['study'] = study
+            study_row['participant'] = study_participant(study, row['participant'])
+            study_rows.append(study_row)
+        keys = [(row['participant'], row['videotime']) for row in rows]
+        results.append((event, (study_rows, [features[key] for key in keys],
+            [counts[key] for key in keys] if counts is not None else None)))
+    return results
+
+def _init_study_worker(values):
+    apply_settings(values)
+    # The cache connection belongs to the main process.
+    use_feature_cache(None)
+
+def _extract_study(task):
+    return extract_study(*task)
+
+def extract_studies(databases, events, workers=1):
+    """extract_study for every (study, db) pair, in the order of the pairs. With more than one worker the
+    studies are extracted by a pool of that many processes, a study at a time each."""
+    tasks = [(study, db, events) for study, db in databases]
+    if workers <= 1 or len(tasks) <= 1:
+        return [extract_study(*task) for task in tasks]
+
+    pool = multiprocessing.Pool(min(workers, len(tasks)), _init_study_worker, (settings(),))
+    try:
+        return pool.map(_extract_study, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+def write_studies(databases, events, outfile, workers=1, compress=False, merge=True):
+    """Extracts the (study, db) pairs with extract_studies and writes the rows of each event to one ARFF file, or
+    to one file for each study with merge False. With more than one event, the files are named after the event
+    like those of write_all_events. Every file of an event has the same attributes: the participant attribute
+    lists the participants of all studies and the n-grams are chosen from all of them. With Constants.COLUMNS the
+    columns are written too, to directories named like the ARFF files. Returns the names of the files."""
+    studies = extract_studies(databases, events, workers)
+
+    outfiles = []
+    for position, event in enumerate(events):
+        event_path = event_outfile(outfile, event) if len(events) > 1 else outfile
+        columns_path = None
+        if Constants.COLUMNS:
+            columns_path = event_outfile(Constants.COLUMNS, event) if len(events) > 1 else Constants.COLUMNS
+        study_parts = [study_events[position][1] for study_events in studies]
+        outfiles += _write_study_event(databases, event, study_parts, event_path, columns_path, compress, merge)
+    return outfiles
+
+def _write_study_event(databases, event, studies, outfile, columns_path, compress, merge):
+    """Writes the (rows, features, counts) of every study for one event, see write_studies."""
+    rows = [row for study_rows, features, counts in studies for row in study_rows]
+    participants = participant_values(rows)
+    ngrams = top_ngrams([row_counts for study_rows, features, counts in studies for row_counts in counts]) \
+        if Constants.NGRAMS else None
+
+    parts = []
+    first = 0
+    for (study, db), (study_rows, features, counts) in izip(databases, studies):
+        parts.append((study, range(first, first + len(study_rows)), features))
+        first += len(study_rows)
+    if merge:
+        parts = [(None, range(len(rows)), [row_features for study, positions, features in parts
+            for row_features in features])]
+
+    outfiles = []
+    for study, positions, features in parts:
+        path = outfile if study is None else event_outfile(outfile, study)
+        part_rows = [rows[position] for position in positions]
+        part_ngrams = ngrams.select(positions) if ngrams is not None else None
+        columns = FeatureColumns() if columns_path else None
+        if columns is not None:
+            features = columns.collect(features)
+
+        write_arff(path, arff_chunks(event, part_rows, features, part_ngrams, participants=participants), compress)
+        if columns is not None:
+            columns.save(columns_path if study is None else event_outfile(columns_path, study), event, part_rows,
+                part_ngrams, participants)
+        outfiles.append(path)
+    return outfiles
+
+
+class FeatureService(object):
+    """Answers requests for the features of one database from a PrefixIndex that is kept between requests, so
+    that only the first request, and the first one after the database changed, reads it. A request is a dictionary with:
+
+    'event': the trigger event, TRIGGER_EVENT when it is not given;
+    'triggers': a list of [participant, videotime] trigger rows, all rows of the event when it is not given;
+    'constants': the Constants of OVERRIDES to use for this request, like {"BEFORE": -30, "TWO_FACTOR": true};
+    'format': 'json' (the default) for the attributes of the header and the values of every row, or 'arff'."""
+
+    OVERRIDES = ['BEFORE', 'FORKSTART', 'FORKEND', 'AFTER', 'NUMERIC', 'CATEGORY', 'BINARY', 'CATEGORY_MAPS',
+        'FEATURES', 'TWO_FACTOR', 'NGRAMS', 'NGRAM_SIZES', 'SPARSE', 'NAME']
+
+    FORMATS = ['json', 'arff']
+
+    def __init__(self, db):
+        self.db = db
+        self.conn = None
+        self.stamp = None
+
+    def refresh(self):
+        """Reads the database again when its file changed since it was read. Returns whether it was read."""
+        stamp = database_stamp(self.db)
+        if stamp == self.stamp:
+            return False
+
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = connect(self.db, read_only=True)
+        c = self.conn.cursor()
+        self.index = PrefixIndex.from_db(c)
+        self.rows = dict((event, list(trigger_rows(c, event))) for event in TRIGGER_EVENTS)
+        self.stamp = stamp
+        return True
+
+    def status(self):
+        return {'db': self.db, 'rows': dict((event, len(rows)) for event, rows in self.rows.iteritems())}
+
+    def overrides(self, constants):
+        """The Constants of a request, checked against OVERRIDES."""
+        unknown = [name for name in constants if name not in self.OVERRIDES]
+        if unknown:
+            raise ValueError("These Constants cannot be set by a request: %s" % ", ".join(sorted(unknown)))
+
+        values = dict((str(name), value) for name, value in constants.iteritems())
+        for name, value in values.iteritems():
+            if not _valid_override(name, value):
+                raise ValueError("Not a valid value of %s: %s" % (name, json.dumps(value)))
+        if 'CATEGORY_MAPS' in values:
+            values['CATEGORY_MAPS'] = dict((name, dict((int(threshold), label) for threshold, label in
+                category_map.iteritems())) for name, category_map in values['CATEGORY_MAPS'].iteritems())
+        return values
+
+    def trigger_rows(self, event, triggers=None):
+        """The trigger rows of the event, or the listed (participant, videotime) ones in their order."""
+        if not isinstance(event, basestring) or event not in self.rows:
+            raise ValueError("Unknown trigger event: %s" % json.dumps(event))
+        if triggers is None:
+            return self.rows[event]
+
+        if not isinstance(triggers, list) or not all(isinstance(trigger, list) and len(trigger) == 2
+                and _is_int(trigger[0]) and isinstance(trigger[1], basestring) for trigger in triggers):
+            raise ValueError("'triggers' must be a list of [participant, videotime] pairs")
+
+        rows = dict(((row['participant'], row['videotime']), row) for row in self.rows[event])
+        missing = [trigger for trigger in triggers if tuple(trigger) not in rows]
+        if missing:
+            raise ValueError("Not trigger rows of %s: %s" % (event, missing))
+        return [rows[tuple(trigger)] for trigger in triggers]
+
+    def features(self, request):
+        """The answer to a request as (content type, body). A request that is not valid raises ValueError."""
+        if not isinstance(request, dict):
+            raise ValueError("A request must be a JSON object")
+        if request.get('format', 'json') not in self.FORMATS:
+            raise ValueError("Unknown format: %s" % json.dumps(request['format']))
+        if not isinstance(request.get('constants', {}), dict):
+            raise ValueError("'constants' must be a JSON object")
+
+        self.refresh()
+        event = request.get('event', Constants.TRIGGER_EVENT)
+        rows = self.trigger_rows(event, request.get('triggers'))
+
+        original = settings()
+        use_event_index(self.index)
+        try:
+            apply_settings(self.overrides(request.get('constants', {})))
+            Constants.ENGINE = 'index'
+
+            c = self.conn.cursor()
+            ngrams = ngram_table(c, rows)
+            participants = participant_values(self.rows[event])
+            all_features = iter_features(self.conn, rows)
+            if request.get('format', 'json') == 'arff':
+                return 'text/plain', "".join(arff_chunks(event, rows, all_features, ngrams, None, participants))
+
+            ngram_rows = ngrams.counts if ngrams is not None else repeat(None)
+            arff_header = header(event, ngrams, participants=participants)
+            return 'application/json', json.dumps({'attributes': header_attributes(arff_header),
+                'rows': [{'participant': row['participant'], 'videotime': row['videotime'],
+                    'values': row_values(features, row, event, ngram_counts=row_ngrams)}
+                    for row, features, row_ngrams in izip(rows, all_features, ngram_rows)]})
+        finally:
+            apply_settings(original)
+            use_event_index(None)
+
+def _is_int(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def _valid_override(name, value):
+    """Whether a value from a request has the type of the Constant it sets."""
+    if name in ('BEFORE', 'FORKSTART', 'FORKEND', 'AFTER'):
+        return _is_int(value)
+    if name in ('NUMERIC', 'CATEGORY', 'BINARY', 'TWO_FACTOR'):
+        return isinstance(value, bool)
+    if name == 'SPARSE':
+        return value is None or isinstance(value, bool)
+    if name == 'NGRAMS':
+        return _is_int(value) and value >= 0
+    if name == 'NGRAM_SIZES':
+        return isinstance(value, list) and all(_is_int(size) and size > 0 for size in value)
+    if name == 'FEATURES':
+        return value is None or isinstance(value, list) and all(isinstance(feature, basestring)
+            for feature in value)
+    if name == 'NAME':
+        return isinstance(value, basestring)
+    if name == 'CATEGORY_MAPS':
+        return isinstance(value, dict) and all(isinstance(category_map, dict) and category_map and all(
+            re.match(r"^-?\d+$", threshold) and isinstance(label, basestring)
+            for threshold, label in category_map.iteritems()) for category_map in value.itervalues())
+    return False
+
+class FeatureRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """POST /features with a JSON request of FeatureService is answered with the features; GET / answers with
+    what is loaded."""
+
+    def reply(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_error(self, code, message):
+        self.reply(code, 'application/json', json.dumps({'error': message}))
+
+    def log_message(self, format, *args):
+        """Requests are not logged, there are too many of them; errors are answered to the client."""
+
+    def do_GET(self):
+        try:
+            self.server.service.refresh()
+            body = json.dumps(self.server.service.status())
+        except Exception as e:
+            self.reply_error(500, "%s: %s" % (type(e).__name__, e))
+            return
+        self.reply(200, 'application/json', body)
+
+    def do_POST(self):
+        if self.path != '/features':
+            self.reply_error(404, "Unknown path: %s" % self.path)
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+            content_type, body = self.server.service.features(request)
+        except ValueError as e:
+            self.reply_error(400, str(e))
+            return
+        except Exception as e:
+            self.reply_error(500, "%s: %s" % (type(e).__name__, e))
+            return
+        self.reply(200, content_type, body)
+
+def feature_server(db, port, host='127.0.0.1'):
+    """An HTTP server of a FeatureService of the database. It answers one request at a time, so the Constants of
+    a request never mix with another's. The database is read in the thread that serves the requests."""
+    server = BaseHTTPServer.HTTPServer((host, port), FeatureRequestHandler)
+    server.service = FeatureService(db)
+    return server
+
+
+def check_settings():
+    """Raises a ValueError for Constants that the run would otherwise ignore: SWEEP and INCREMENTAL each write
+    their own files, and neither they nor PROGRESS are done for all events at once or for DATABASES."""
+    modes = [name for name in ('SWEEP', 'INCREMENTAL') if getattr(Constants, name)]
+    if len(modes) > 1:
+        raise ValueError("SWEEP and INCREMENTAL cannot be used together")
+
+    ignored = modes + (['PROGRESS'] if Constants.PROGRESS else [])
+    if ignored and Constants.DATABASES:
+        raise ValueError("%s cannot be used with DATABASES" % " and ".join(ignored))
+    if ignored and Constants.TRIGGER_EVENT == 'All':
+        raise ValueError("%s cannot be used with TRIGGER_EVENT 'All'" % " and ".join(ignored))
+
+
 if __name__ == "__main__":
-    conn = sqlite3.connect(Constants.DB)
-    conn.row_factory = sqlite3.Row
+    if Constants.SERVE:
+        server = feature_server(Constants.DB, Constants.SERVE)
+        sys.stderr.write("Serving features of %s on http://%s:%d/\n" % ((Constants.DB,) + server.server_address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    check_settings()
+    if Constants.DATABASES:
+        outfile = Constants.OUTFILE + (".gz" if Constants.GZIP else "")
+        events = TRIGGER_EVENTS if Constants.TRIGGER_EVENT == 'All' else [Constants.TRIGGER_EVENT]
+        write_studies(sorted(Constants.DATABASES.items()), events, outfile, Constants.WORKERS, Constants.GZIP,
+            Constants.MERGE)
+        sys.exit(0)
+
+    conn = connect(Constants.DB, profile=bool(Constants.PROFILE))
     c = conn.cursor()
 
-    with open(Constants.OUTFILE, 'w') as f:
-        output = header(Constants.TRIGGER_EVENT)
+    if Constants.PROFILE:
+        use_profiler(Profiler())
+        _profiler.attach(conn)
+
+    if Constants.PREPARE:
+        prepare_database(conn)
+
+    if Constants.CACHE:
+        use_feature_cache(FeatureCache(Constants.CACHE, database_fingerprint(Constants.DB), Constants.CACHE_ROWS))
+
+    outfile = Constants.OUTFILE
+    if Constants.GZIP:
+        outfile += ".gz"
 
-        if Constants.TRIGGER_EVENT == 'Fork':
-            for row in confirmed_forks(c):
-                # print row
-                features = gather_features(conn.cursor(), row)
-                output += features_to_datatable(features, row, Constants.TRIGGER_EVENT)
+    if Constants.ENGINE == 'index' and Constants.STORE:
+        store = snapshot_store(c, Constants.STORE, Constants.DB)
+        if Constants.WORKERS <= 1 and not Constants.SWEEP:
+            use_event_index(EventIndex.from_store(store))
+    elif Constants.ENGINE == 'index' and Constants.WORKERS <= 1 and not Constants.SWEEP:
+        use_event_index(EventIndex.from_db(c))
+
+    if Constants.TRIGGER_EVENT == 'All':
+        write_all_events(conn, TRIGGER_EVENTS, outfile, Constants.DB, Constants.WORKERS, Constants.GZIP)
+    else:
+        rows = list(trigger_rows(c, Constants.TRIGGER_EVENT))
+
+        if Constants.SWEEP:
+            sweep(conn, rows, Constants.TRIGGER_EVENT, sweep_grid(Constants.SWEEP), outfile)
+        elif Constants.INCREMENTAL:
+            path = Constants.INCREMENTAL
+            if Constants.GZIP and not path.endswith(".gz"):
+                path += ".gz"
+            update_arff(conn, rows, Constants.TRIGGER_EVENT, path, Constants.DB, Constants.WORKERS)
+        else:
+            all_features = iter_features(conn, rows, Constants.DB, Constants.WORKERS)
+            if Constants.PROGRESS:
+                all_features = report_progress(all_features, len(rows))
 
-        elif Constants.TRIGGER_EVENT == 'Foraging':
-            for row in confirmed_foraging_changes(c):
-                features = gather_features(conn.cursor(), row)
-                output += features_to_datatable(features, row, Constants.TRIGGER_EVENT)
+            columns = FeatureColumns() if Constants.COLUMNS else None
+            if columns is not None:
+                all_features = columns.collect(all_features)
 
-        elif Constants.TRIGGER_EVENT == 'ForagingEnd':
-            for row in confirmed_foraging_end(c):
-                features = gather_features(conn.cursor(), row)
-                output += features_to_datatable(features, row, Constants.TRIGGER_EVENT)
+            ngrams = ngram_table(c, rows)
+            write_arff(outfile, arff_chunks(Constants.TRIGGER_EVENT, rows, all_features, ngrams), Constants.GZIP)
+            if columns is not None:
+                columns.save(Constants.COLUMNS, Constants.TRIGGER_EVENT, rows, ngrams)
 
-        print output
-        f.write(output)
+    if _feature_cache is not None:
+        _feature_cache.close()
 
+    if _profiler is not None:
+        _profiler.write(Constants.PROFILE)
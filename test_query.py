@@ -35,8 +35,6 @@ def confirmed_forks(c):
     return c.execute(forks_query)
 
 def exists_search_before_open(conn, c, fork_row, start, after):
-    exists = False
-
     q = "SELECT * FROM commands WHERE \
         eclipsecommand = ? \
         AND EXISTS \
@@ -56,16 +54,16 @@ def exists_search_before_open(conn, c, fork_row, start, after):
         result_set_forks = c.execute(q, (i,
             fork_row['participant'], fork_row['videotime'],
             start, after,
-            fork_row['participant']))
+            fork_row['participant'])).fetchall()
 
         for j in result_set_forks:
             search_time = j['videotime']
             
-            result_set_opens = c.execute(r, (search_time, fork_row['videotime']))
-            for k in result_set_opens:
-                exists = True
+            result_set_opens = c.execute(r + " LIMIT 1", (search_time, fork_row['videotime']))
+            if result_set_opens.fetchone() is not None:
+                return True
 
-    return exists
+    return False
 
 if __name__ == "__main__":
     conn = sqlite3.connect(Constants.DB)